@@ -4,8 +4,12 @@ import numpy as np
 import scipy as sp
 import numba as nb
 # import quadpy as qp
-from scipy import integrate, interpolate
+from scipy import integrate, interpolate, linalg
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
 from estimate_L import *
+from policy import GibbsPolicy, gaussLegendre, logGibbs
+from snapshots import SnapshotBuffer
 # from cartpole_reward import cartpoleReward
 
 @nb.njit(fastmath=True)
@@ -66,10 +70,128 @@ def ln(x):
 #     result[-1] = u
 #     return result
 
+#%% Fixed action grid quadrature
+def batchReward(reward, X, U, vectorized_reward=False):
+    '''
+    Evaluates reward for the columns of X paired with the entries of U.
+    '''
+    if vectorized_reward:
+        return np.asarray(reward(X, U)).reshape(-1)
+    return np.array([reward(x, u) for x, u in zip(X.T, U)])
+
+def actionGrid(X, psi, reward, nodes, vectorized_reward=False):
+    '''
+    Pairs every state in X with every action node and lifts all pairs at once.
+    Returns the [m, n_nodes] reward matrix and the [k, m*n_nodes] lifted grid.
+    '''
+    m = X.shape[1]
+    n_nodes = nodes.shape[0]
+    X_tilde_grid = np.append(np.repeat(X, n_nodes, axis=1), [np.tile(nodes, m)], axis=0)
+    R = batchReward(reward, X_tilde_grid[:-1], X_tilde_grid[-1], vectorized_reward).reshape(m, n_nodes)
+    return R, psi(X_tilde_grid)
+
+class BellmanOperator(object):
+    '''
+    reward + Lv_hat for one value iteration step, compiled from the generator L and the
+    value regression coefficients B_v so that (L @ B_v).T is formed once per iteration.
+    '''
+
+    def __init__(self, coefficients, psi, reward, vectorized_reward=False):
+        self.coefficients = np.asarray(coefficients).reshape(-1)
+        self.psi = psi
+        self.reward = reward
+        self.vectorized_reward = vectorized_reward
+
+    @classmethod
+    def fromGenerator(cls, L, B_v, psi, reward, vectorized_reward=False):
+        return cls((L @ B_v).T[0], psi, reward, vectorized_reward)
+
+    def __call__(self, X, U):
+        '''
+        reward(x, u) + Lv_hat(x, u) for the columns of X paired with the entries of U,
+        with one dictionary lift and one matvec.
+        '''
+        U = np.asarray(U, dtype=float).reshape(-1)
+        X_tilde = np.append(X, [U], axis=0)
+        return batchReward(self.reward, X, U, self.vectorized_reward) + self.coefficients @ self.psi(X_tilde)
+
+    def lifted(self, R, Psi_X_tilde):
+        '''
+        Same as calling the operator when rewards R and lifted pairs Psi_X_tilde are known.
+        '''
+        return R + (self.coefficients @ Psi_X_tilde).reshape(R.shape)
+
+def gaussBackup(bellman, R, Psi_grid, weights, lamb):
+    '''
+    Soft Bellman backup for every state at once on a fixed action grid.
+    Returns V and the log-partition function of the Gibbs policy for every state.
+    '''
+    Q = bellman.lifted(R, Psi_grid) # reward + Lv_hat
+    _, log_Z = logGibbs(Q, lamb, weights)
+    return lamb * log_Z, log_Z
+
+def adaptiveValue(x, policy, low, high):
+    '''
+    V(x) = int (reward + Lv_hat - lamb * log pi) pi du with scipy's adaptive quad.
+    '''
+    x = x.reshape(-1,1)
+    def integrand(u):
+        log_pi = policy.log_pi(u, x)[0]
+        return (policy.score(x, np.array([u]))[0] - policy.lamb * log_pi) * np.exp(log_pi)
+    return integrate.quad(integrand, low, high)[0]
+
+#%% Parallel value iteration over states
+def _shareArray(A):
+    shm = shared_memory.SharedMemory(create=True, size=A.nbytes)
+    np.ndarray(A.shape, dtype=A.dtype, buffer=shm.buf)[:] = A
+    return shm, (shm.name, A.shape, A.dtype.str)
+
+def _attachArray(spec, inds=None):
+    # copies out what is needed so the segment can be closed straight away
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    A = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    A = A.copy() if inds is None else A[:, inds].copy()
+    shm.close()
+    return A
+
+def _shardValues(args):
+    inds, X_spec, coefficients_spec, psi, reward, action_bounds, lamb, vectorized_reward = args
+    X_shard = _attachArray(X_spec, inds)
+    bellman = BellmanOperator(_attachArray(coefficients_spec), psi, reward, vectorized_reward)
+    policy = GibbsPolicy(bellman, action_bounds, lamb, None)
+    values = np.array([adaptiveValue(x, policy, *action_bounds) for x in X_shard.T])
+    return inds, values
+
 #%% Algorithm 1
 #? arg for (epsilon=0.1,)?
 # TODO: Make sure np.real() calls are where they need to be
-def learningAlgorithm(L, X, psi, Psi_X_tilde, action_bounds, reward, timesteps=100, cutoff=8, lamb=10):
+def learningAlgorithm(
+    L, X, psi, Psi_X_tilde, action_bounds, reward, timesteps=100, cutoff=8, lamb=10,
+    quadrature='gauss', n_nodes=16, quad_tol=None, max_nodes=256, vectorized_reward=False,
+    n_workers=1, progress=None, V0=None, tol=None, rtol=None
+):
+    '''
+    Soft value iteration with the Koopman generator L.
+
+    quadrature='gauss' integrates over actions on a fixed Gauss-Legendre grid of
+    n_nodes points for all states at once. If quad_tol is set, the grid is doubled
+    (up to max_nodes) until the sup-norm difference between the n and 2n node
+    estimates of V is below quad_tol. quadrature='adaptive' uses scipy's quad per state.
+
+    With quadrature='adaptive' and n_workers > 1 the states are sharded across a process
+    pool; X is placed in shared memory once and the value coefficients once per iteration,
+    so psi and reward must be picklable (the Gauss backup is a single batch and does not
+    take workers). progress(done, total) is called as states finish, once per sweep with
+    quadrature='gauss'.
+
+    V0 warm-starts the iteration (e.g. with the values of the previous policy). If tol or
+    rtol is set, iteration stops once max|V_t - V_{t-1}| <= tol + rtol * max|V_{t-1}|,
+    with timesteps as the maximum number of sweeps.
+    '''
+    if quadrature == 'gauss' and n_workers > 1:
+        raise ValueError("n_workers > 1 requires quadrature='adaptive'")
+
     # _divmax = 25
     Psi_X_tilde_T = Psi_X_tilde.T
 
@@ -80,18 +202,19 @@ def learningAlgorithm(L, X, psi, Psi_X_tilde, action_bounds, reward, timesteps=1
     low = action_bounds[0]
     high = action_bounds[1]
 
-    constant = 1/lamb
-
-    # eigenvalues, eigenvectors = sp.linalg.eig(L) # L created with X_tilde
+    # eigenvalues, eigenvectors = linalg.eig(L) # L created with X_tilde
     # eigenvalues = np.real(eigenvalues)
     # eigenvectors = np.real(eigenvectors)
     # @nb.njit(fastmath=True)
     # def eigenfunctions(ell, psi_x_tilde):
     #     return np.dot(eigenvectors[ell], psi_x_tilde)[0]
 
-    # eigenvectors_inverse_transpose = sp.linalg.inv(eigenvectors).T # pseudoinverse?
+    # eigenvectors_inverse_transpose = linalg.inv(eigenvectors).T # pseudoinverse?
 
-    currentV = np.zeros(X.shape[1]) # V^{\pi*_0}
+    if V0 is None:
+        currentV = np.zeros(X.shape[1]) # V^{\pi*_0}
+    else:
+        currentV = np.array(V0, dtype=float).reshape(-1)
     lastV = currentV.copy()
     # G_X_tilde = np.empty((currentV.shape[0], currentV.shape[0]))
 
@@ -99,82 +222,110 @@ def learningAlgorithm(L, X, psi, Psi_X_tilde, action_bounds, reward, timesteps=1
     # https://docs.scipy.org/doc/scipy/reference/generated/scipy.integrate.RK45.html
     # scipy.integrate.RK45(fun, t0, y0, t_bound, max_step=inf, rtol=0.001, atol=1e-06, vectorized=False, first_step=None, **extraneous)
     # Not really sure how to replace romberg with that...
-    t = 0
-    while t < timesteps:
-        G_X_tilde = currentV.copy()
-        B_v = rrr(Psi_X_tilde_T, G_X_tilde.reshape(-1,1))
-
-        # generatorModes = B_v.T @ eigenvectors_inverse_transpose
-
-        # @nb.jit(forceobj=True, fastmath=True)
-        def Lv_hat(x, u):
-            # print("Lv_hat")
-
-            # psi_x_tilde = psi(x_tilde.reshape(-1,1))
-            # summation = 0
-            # for ell in range(cutoff):
-            #     summation += generatorModes[ell] * eigenvalues[ell] * eigenfunctions(ell, psi_x_tilde)
-            # return summation
-
-            x_tilde = np.append(x, u)
-            return (L @ B_v).T @ psi(x_tilde.reshape(-1,1))
-
-        # @nb.jit(forceobj=True, fastmath=True)
-        def compute(u, x):
-            # print("compute")
-
-            inner = (constant * (reward(x, u) + Lv_hat(x, u)[0,0]))
-            if inner > 700: inner = 700
-            return np.array(np.exp(inner))
-        # vec_compute = np.vectorize(compute)
-        # vec_compute.excluded.add(1)
-
-        def pi_hat_star(u, x): # action given state
-            # print("pi_hat_star")
-
-            numerator = compute(u, x)
-            denominator = integrate.quad(compute, low, high, args=(x,))[0]
-            return numerator / denominator
-
-        def compute_2(u, x):
-            # print("compute_2")
-
-            eval_pi_hat_star = pi_hat_star(u, x)
-            return (reward(x, u) - (lamb * ln(eval_pi_hat_star)) + Lv_hat(x, u)[0,0]) * eval_pi_hat_star
-        # vec_compute_2 = np.vectorize(compute_2)
-        # vec_compute_2.excluded.add(1)
-
-        # def integral_summation(x):
-        #     # print("integral_summation")
-
-        #     summation = 0
-        #     for ell in range(cutoff):
-        #         summation += generatorModes[ell] * eigenvalues[ell] * \
-        #             integrate.romberg(
-        #                 lambda u, x: eigenfunctions(ell, psi(np.append(x, u).reshape(-1,1))) * pi_hat_star(u, x),
-        #                 low, high, args=(x,), divmax=_divmax
-        #             )
-        #     return summation
-
-        def V(x):
-            # print("V")
-
-            # return (integrate.romberg(compute_2, low, high, args=(x,), divmax=_divmax) + \
-            #             integral_summation(x))
-
-            return integrate.quad(compute_2, low, high, args=(x,))[0]
-
-        lastV = currentV
-        for i in range(currentV.shape[0]):
-            x = X[:,i]
-            currentV[i] = V(x)
-            if i % 250 == 0:
-                print(i+1)
-
-        t+=1
-        print("Completed learning step", t)
-    
-    return currentV, pi_hat_star
+    # only the current resolution is kept, refinement compares values and not grids
+    grids = {}
+    def grid(n):
+        if n not in grids:
+            grids.clear()
+            nodes, weights = gaussLegendre(low, high, n)
+            R, Psi_grid = actionGrid(X, psi, reward, nodes, vectorized_reward)
+            grids[n] = (nodes, weights, R, Psi_grid)
+        return grids[n]
+
+    # the pool and the shared states are released however the sweeps end
+    pool = None
+    X_shm = None
+    try:
+        if quadrature != 'gauss' and n_workers > 1:
+            pool = ProcessPoolExecutor(max_workers=n_workers)
+            X_shm, X_spec = _shareArray(np.ascontiguousarray(X, dtype=float))
+
+        t = 0
+        while t < timesteps:
+            G_X_tilde = currentV.copy()
+            B_v = rrr(Psi_X_tilde_T, G_X_tilde.reshape(-1,1))
+
+            # generatorModes = B_v.T @ eigenvectors_inverse_transpose
+
+            bellman = BellmanOperator.fromGenerator(L, B_v, psi, reward, vectorized_reward)
+
+            # action given state, caches the normalising integral per state
+            pi_hat_star = GibbsPolicy(
+                bellman, action_bounds, lamb, n_nodes if quadrature == 'gauss' else None
+            )
+
+            # def integral_summation(x):
+            #     # print("integral_summation")
+
+            #     summation = 0
+            #     for ell in range(cutoff):
+            #         summation += generatorModes[ell] * eigenvalues[ell] * \
+            #             integrate.romberg(
+            #                 lambda u, x: eigenfunctions(ell, psi(np.append(x, u).reshape(-1,1))) * pi_hat_star(u, x),
+            #                 low, high, args=(x,), divmax=_divmax
+            #             )
+            #     return summation
+
+            def V(x):
+                # print("V")
+
+                # return (integrate.romberg(compute_2, low, high, args=(x,), divmax=_divmax) + \
+                #             integral_summation(x))
+
+                return adaptiveValue(x, pi_hat_star, low, high)
+
+            lastV = currentV
+            if quadrature == 'gauss':
+                _, weights, R, Psi_grid = grid(n_nodes)
+                currentV, log_Z = gaussBackup(bellman, R, Psi_grid, weights, lamb)
+                while quad_tol is not None and n_nodes < max_nodes:
+                    n_nodes *= 2
+                    _, weights, R, Psi_grid = grid(n_nodes)
+                    refinedV, log_Z = gaussBackup(bellman, R, Psi_grid, weights, lamb)
+                    converged = np.max(np.abs(refinedV - currentV)) <= quad_tol
+                    currentV = refinedV
+                    if converged: break
+                pi_hat_star = GibbsPolicy(bellman, action_bounds, lamb, n_nodes)
+                pi_hat_star.cache(X, log_Z)
+                if progress is not None: progress(X.shape[1], X.shape[1])
+            elif pool is not None:
+                currentV = currentV.copy()
+                coefficients_shm, coefficients_spec = _shareArray(bellman.coefficients)
+                try:
+                    futures = [
+                        pool.submit(_shardValues, (
+                            inds, X_spec, coefficients_spec, psi, reward, action_bounds, lamb, vectorized_reward
+                        ))
+                        for inds in np.array_split(np.arange(X.shape[1]), 4 * n_workers)
+                    ]
+                    done = 0
+                    for future in as_completed(futures):
+                        inds, values = future.result()
+                        currentV[inds] = values
+                        done += inds.shape[0]
+                        if progress is not None: progress(done, X.shape[1])
+                finally:
+                    coefficients_shm.close()
+                    coefficients_shm.unlink()
+            else:
+                currentV = currentV.copy()
+                for i in range(currentV.shape[0]):
+                    x = X[:,i]
+                    currentV[i] = V(x)
+                    if progress is not None: progress(i+1, X.shape[1])
+
+            t+=1
+
+            if tol is not None or rtol is not None:
+                change = np.max(np.abs(currentV - lastV))
+                if change <= (tol or 0) + (rtol or 0) * np.max(np.abs(lastV)): break
+
+        return currentV, pi_hat_star
+    finally:
+        if pool is not None: pool.shutdown()
+        if X_shm is not None:
+            X_shm.close()
+            X_shm.unlink()
 
 #%%
 # V, pi = learningAlgorithm(L, X, psi, Psi_X_tilde, np.array([0,1]), cartpoleReward, timesteps=4, lamb=10)
@@ -233,28 +384,108 @@ def rgEDMD(
     z_m,
     phi_m_inverse
 ):
+    # rank-one case of the block update below
+    return blockRgEDMD(
+        dPsi_X_tilde[:,-2].reshape(-1,1),
+        Psi_X_tilde_m.reshape(-1,1),
+        z_m,
+        phi_m_inverse
+    )
+
+def blockRgEDMD(dPsi_block, Psi_block, z_m, phi_m_inverse, forgetting=1.0):
+    '''
+    Recursive gEDMD update with a mini-batch of b snapshots (the columns of Psi_block and
+    dPsi_block) as one rank-b Woodbury update. forgetting < 1 discounts old snapshots.
+    '''
     # update z_m
-    z_m = z_m + dPsi_X_tilde[:,-2].reshape(-1,1) @ Psi_X_tilde_m.T
+    z_m = forgetting * z_m + dPsi_block @ Psi_block.T
+
+    # update \phi_m^{-1} = (forgetting * \phi_m + Psi_block Psi_block^T)^{-1}
+    G = phi_m_inverse @ Psi_block
+    S = forgetting * np.identity(Psi_block.shape[1]) + Psi_block.T @ G
+    phi_m_inverse = (phi_m_inverse - G @ np.linalg.solve(S, G.T)) / forgetting
+    phi_m_inverse = 0.5 * (phi_m_inverse + phi_m_inverse.T)
 
-    # update \phi_m^{-1}
-    phi_m_inverse = phi_m_inverse - \
-                    ((phi_m_inverse @ Psi_X_tilde_m @ Psi_X_tilde_m.T @ phi_m_inverse) / \
-                        (1 + Psi_X_tilde_m.T @ phi_m_inverse @ Psi_X_tilde_m))
-    
     L_m = z_m @ phi_m_inverse
 
     # updated z_m, updated \phi_m^{-1}, and \mathcal{L}_m
     return z_m, phi_m_inverse, L_m
 
+class RecursiveGeneratorEDMD(object):
+    '''
+    Recursive gEDMD with mini-batch Woodbury updates.
+
+    sqrt_form=True propagates an upper triangular factor R with phi_m = R^T R through QR
+    updates instead of phi_m^{-1}. Every refactor_every updates the inverse (or R) is
+    recomputed from phi_m itself to bound the accumulated rounding drift. forgetting < 1
+    exponentially discounts old snapshots for non-stationary plants.
+    '''
+
+    def __init__(self, k, forgetting=1.0, sqrt_form=False, refactor_every=None, regularization=1.0):
+        self.forgetting = forgetting
+        self.sqrt_form = sqrt_form
+        self.refactor_every = refactor_every
+        self.z_m = np.zeros((k,k))
+        self.phi_m = regularization * np.identity(k)
+        self._phi_m_inverse = np.identity(k) / regularization
+        self.R = np.sqrt(regularization) * np.identity(k)
+        self.num_updates = 0
+
+    @property
+    def phi_m_inverse(self):
+        if self.sqrt_form:
+            return linalg.cho_solve((self.R, False), np.identity(self.R.shape[0]))
+        return self._phi_m_inverse
+
+    @property
+    def L(self):
+        if self.sqrt_form:
+            return linalg.cho_solve((self.R, False), self.z_m.T).T
+        return self.z_m @ self._phi_m_inverse
+
+    def update(self, dPsi_block, Psi_block):
+        '''
+        Adds the columns of Psi_block and dPsi_block and returns the updated L_m.
+        '''
+        Psi_block = Psi_block.reshape(Psi_block.shape[0], -1)
+        dPsi_block = dPsi_block.reshape(dPsi_block.shape[0], -1)
+        f = self.forgetting
+
+        self.phi_m = f * self.phi_m + Psi_block @ Psi_block.T
+        if self.sqrt_form:
+            self.z_m = f * self.z_m + dPsi_block @ Psi_block.T
+            self.R = np.linalg.qr(np.append(np.sqrt(f) * self.R, Psi_block.T, axis=0), mode='r')
+        else:
+            self.z_m, self._phi_m_inverse, _ = blockRgEDMD(
+                dPsi_block, Psi_block, self.z_m, self._phi_m_inverse, f
+            )
+
+        self.num_updates += 1
+        if self.refactor_every is not None and self.num_updates % self.refactor_every == 0:
+            self.refactor()
+
+        return self.L
+
+    def refactor(self):
+        '''
+        Recomputes the inverse (or its square root) directly from phi_m.
+        '''
+        if self.sqrt_form:
+            self.R = linalg.cholesky(self.phi_m)
+        else:
+            self._phi_m_inverse = linalg.cho_solve(
+                linalg.cho_factor(self.phi_m), np.identity(self.phi_m.shape[0])
+            )
+
 #%% Algorithm 3
 # running this would take an infeasible amount of time to so instead,
 # comment out line the learningAlgorithm call in the loop and uncommment
 # the learningAlgorithm call outside of the loop for testing
 @nb.jit(forceobj=True, fastmath=True)
 def onlineKoopmanLearning(X_tilde, Psi_X_tilde, dPsi_X_tilde):
-    X_tilde_builder = X_tilde[:,:2]
-    Psi_X_tilde_builder = Psi_X_tilde[:,:2]
-    dPsi_X_tilde_builder = dPsi_X_tilde[:,:2]
+    X_tilde_builder = SnapshotBuffer.fromArray(X_tilde[:,:2])
+    Psi_X_tilde_builder = SnapshotBuffer.fromArray(Psi_X_tilde[:,:2])
+    dPsi_X_tilde_builder = SnapshotBuffer.fromArray(dPsi_X_tilde[:,:2])
     k = dPsi_X_tilde_builder.shape[0]
 
     z_m = np.zeros((k,k))
@@ -262,16 +493,15 @@ def onlineKoopmanLearning(X_tilde, Psi_X_tilde, dPsi_X_tilde):
     for x_tilde in X_tilde:
         x_tilde = x_tilde.reshape(-1,1)
 
-        X_tilde_builder = np.append(X_tilde_builder, x_tilde, axis=1)
-        Psi_X_tilde_builder = np.append(Psi_X_tilde_builder, psi(x_tilde), axis=1)
-        for l in range(k):
-            dPsi_X_tilde_builder[l, -1] = dpsi(X_tilde_builder, l, -2)
-        dPsi_X_tilde_builder = np.append(dPsi_X_tilde_builder, np.zeros((k,1)), axis=1)
+        X_tilde_builder.append(x_tilde)
+        Psi_X_tilde_builder.append(psi(x_tilde))
+        dPsi_X_tilde_builder.set_column(-1, [dpsi(X_tilde_builder.view(), l, -2) for l in range(k)])
+        dPsi_X_tilde_builder.append(np.zeros(k))
 
         Psi_X_tilde_m = Psi_X_tilde[:,-1].reshape(-1,1)
 
         z_m, phi_m_inverse, L_m = rgEDMD(
-            dPsi_X_tilde_builder, Psi_X_tilde_m, z_m, phi_m_inverse
+            dPsi_X_tilde_builder.view(), Psi_X_tilde_m, z_m, phi_m_inverse
         )
         # _, pi = learningAlgorithm(L, X, Psi_X_tilde, np.array([0,1]), cartpoleReward, timesteps=2, lamb=1)
 
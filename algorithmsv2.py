@@ -1,5 +1,6 @@
 import numpy as np
-import mpmath as mp
+from koopman_tensor import KoopmanTensor
+from policy import costTable, DiscreteGibbsPolicy
 
 # you can pass functions as parameters to jitted functions IF AND ONLY IF they re also jitted
 
@@ -13,43 +14,118 @@ def rho(u, o='unif', a=0 ,b=1):
 def K_u(K, psi_u):
     return np.einsum('ijz,z->ij', K, psi_u)
 
-def algorithm2(X, U, phi, psi, K_hat, cost, learning_rate=0.1, epsilon=1):
+def actionColumns(U):
+    '''
+    The possible actions as a list, U holds one action per row or per column of a row vector.
+    '''
+    U = np.asarray(U)
+    if U.ndim == 2 and U.shape[0] == 1: return list(U[0])
+    return [u[0] if np.ndim(u) > 0 and np.size(u) == 1 else u for u in U]
+
+def bellmanErrors(policy, Phi_X, C):
+    '''
+    Squared Bellman residuals ( w phi(x) - sum_u ( cost - log_pi - w K_u phi(x) ) pi )^2
+    for every column of Phi_X at once, with the normalised Gibbs policy
+    pi(u|x) proportional to exp(-(cost + w K_u phi(x)) / lamb) of a DiscreteGibbsPolicy.
+
+        Parameters:
+            policy: DiscreteGibbsPolicy holding the value function weights w
+            Phi_X: [k, b] lifted states
+            C: [b, A] costs of every action in every state
+
+        Returns:
+            errors: b squared residuals
+    '''
+    # w K_u phi(x) for every (x, u) pair as a [b, A] matrix
+    next_values = policy.next_values(Phi_X)
+    log_pi = policy.log_pi_table(Phi_X, C)
+    expectation_u = np.sum((C - log_pi - next_values) * np.exp(log_pi), axis=1)
+    return np.power(policy.w @ Phi_X - expectation_u, 2)
+
+def algorithm2(
+    X, U, phi, psi, K_hat, cost, learning_rate=0.1, epsilon=1,
+    batch_size=32, check_every=100, max_steps=10000, rng=None, progress=None
+):
+    '''
+    Stochastic gradient descent on the Bellman residual with mini-batches of states.
+
+    All lifts, action operators K_u and costs are tabulated once, so each step is a fixed
+    number of array operations. The mini-batch estimate of the error is tracked every
+    step, the full error over X is only evaluated every check_every steps (or when the
+    estimate drops below epsilon), and the loop stops once it is below epsilon or after
+    max_steps steps. A FloatingPointError is raised if w or the error stop being finite.
+
+        Parameters:
+            X: [d, m] states
+            U: All possible actions
+            phi: State dictionary
+            psi: Action dictionary
+            K_hat: [k, k, z] Koopman tensor
+            cost: Cost function cost(x, u)
+            batch_size: Number of states per step
+            check_every: Number of steps between full Bellman error evaluations
+            max_steps: Maximum number of steps
+            rng: numpy Generator (defaults to np.random.default_rng())
+            progress: Optional callback progress(step, BE) after every full error evaluation
+
+        Returns:
+            pi: Policy pi(u, x) for the final weights
+    '''
+    if rng is None: rng = np.random.default_rng()
     num_lifted_state_features = K_hat.shape[0]
-    num_lifted_action_features = K_hat.shape[2]
 
     w = np.empty(num_lifted_state_features)
     w.fill(1)
 
     def pi(u, x):
-        return mp.exp(-1 * (cost(x, u) + w @ K_u(K_hat, psi(u)) @ phi(x)))
-
-    x1 = X[:, int(np.random.uniform(0, X.shape[1]))]
-    def bellmanError(w, pi):
-        total = 0
-        for i in range(X.shape[1]):
-            phi_x = phi(x1)
-            expectation_u = 0
-            for u in U: # U is a collection of ALL possible actions as row vectors
-                u = u[0]
-                expectation_u += ( cost(x1, u) - mp.log( pi(u, x1) ) - w @ K_u(K_hat, psi(u)) @ phi_x ) * pi(u, x1)
-            total += np.power(( w @ phi_x - expectation_u ), 2)
-        return total
-
-    BE = bellmanError(w, pi)
-    while BE > epsilon:
-        # These are row vectors
-        u1 = U[0, int(np.random.uniform(0, num_lifted_action_features))]
-        u2 = U[0, int(np.random.uniform(0, num_lifted_action_features))]
-        x1 = X[:, int(np.random.uniform(0, X.shape[1]))]
-
-        phi_x1 = phi(x1)
-        nabla_w = ( w @ phi_x1 \
-            - ( ( pi(u1, x1) / rho(u1, b=num_lifted_action_features) ) * ( cost(x1, u1) + mp.log( pi(u1, x1) ) + w @ K_u(K_hat, psi(u1)) @ phi_x1 ) ) ) \
-            * ( phi_x1 - ( pi(u2, x1) / rho(u2, b=num_lifted_action_features) ) * K_u(K_hat, psi(u2)) @ phi_x1 )
+        C_x = np.array([[cost(x, action) for action in actions]])
+        log_pi_x = policy.log_pi_table(phi(x).reshape(-1,1), C_x)[0]
+        return np.exp(log_pi_x[tensor.action_index(u)[0][0]])
+
+    actions = actionColumns(U)
+    num_actions = len(actions)
+    m = X.shape[1]
+    Phi_X = np.array([phi(x) for x in X.T]).T
+    tensor = KoopmanTensor(K_hat, psi, actions)
+    K_U = tensor.K_U
+    C = costTable(cost, X, actions)
+    inverse_rho = 1 / rho(0, b=num_actions)
+    policy = DiscreteGibbsPolicy(tensor, w)
+
+    BE = np.sum(bellmanErrors(policy, Phi_X, C))
+    step = 0
+    while BE > epsilon and step < max_steps:
+        inds = rng.integers(0, m, batch_size)
+        u1 = rng.integers(0, num_actions, batch_size)
+        u2 = rng.integers(0, num_actions, batch_size)
+        Phi_x1 = Phi_X[:, inds]
+
+        # importance sampled single-action estimates of both expectations, the
+        # probabilities are normalised over all actions so the exponents stay bounded
+        rows = np.arange(batch_size)
+        log_pi_batch = policy.log_pi_table(Phi_x1, C[inds])
+        K_phi_1 = np.einsum('bij,jb->bi', K_U[u1], Phi_x1)
+        K_phi_2 = np.einsum('bij,jb->bi', K_U[u2], Phi_x1)
+        next_value_1 = K_phi_1 @ w
+        log_pi_1 = log_pi_batch[rows, u1]
+        log_pi_2 = log_pi_batch[rows, u2]
+        residuals = w @ Phi_x1 \
+            - inverse_rho * np.exp(log_pi_1) * (C[inds, u1] + log_pi_1 + next_value_1)
+        directions = Phi_x1.T - inverse_rho * np.exp(log_pi_2)[:, None] * K_phi_2
+        nabla_w = residuals @ directions / batch_size
 
         w = w - (learning_rate * nabla_w)
+        policy.w = w
+        step += 1
+        if not np.all(np.isfinite(w)):
+            raise FloatingPointError('Weights stopped being finite at step %d' % step)
 
-        BE = bellmanError(w, pi)
-        print(BE) # not decreasing at all (value is around 19000)
+        # scaled to the full data so it is comparable with epsilon
+        BE_estimate = m * np.mean(bellmanErrors(policy, Phi_x1, C[inds]))
+        if step % check_every == 0 or BE_estimate <= epsilon:
+            BE = np.sum(bellmanErrors(policy, Phi_X, C))
+            if not np.isfinite(BE):
+                raise FloatingPointError('Bellman error stopped being finite at step %d' % step)
+            if progress is not None: progress(step, BE)
 
-    return pi
\ No newline at end of file
+    return pi
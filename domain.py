@@ -25,6 +25,10 @@ class discretization(object):
         self._boxes = boxes # number of boxes per dimension
         self._h = _np.divide(bounds[:, 1] - bounds[:, 0], boxes) # length of interval in each direction
         self._d = boxes.size # number of dimensions
+        # grids and box geometry are built on first use and cached
+        self._midpointAxes = None
+        self._midpointGrid = None
+        self._vertexGrid = None
 
     def __repr__(self):
         return 'Disretization of %s into %s boxes.' \
@@ -77,52 +81,94 @@ class discretization(object):
 
     def index(self, x):
         '''
-        Finds corresponding index of the box that contains vector x.
+        Finds corresponding index of the box that contains vector x (-1 if x is outside).
+        For a [d, m] array of points returns the m indices and a mask of the valid ones.
         '''
-        mind = self.mindex(x)
-        if _np.any(mind == -1): return -1 # invalid index
-        return indexM2S(mind, self._boxes)
+        x = _np.asarray(x)
+        mind, valid = self.mindex(x.reshape(self._d, -1))
+        ind = -1*_np.ones(valid.shape[0], dtype=int)
+        ind[valid] = indexM2S(tuple(mind[:, valid]), self._boxes)
+        if x.ndim == 1: return ind[0]
+        return ind, valid
 
     def mindex(self, x):
         '''
-        Finds corresponding multi-index of the box that contains x.
+        Finds corresponding multi-index of the box that contains x (all -1 if x is outside).
+        For a [d, m] array of points returns the [d, m] multi-indices and a mask of the
+        points inside the domain.
         '''
-        mind = -1*_np.ones(self._d, _np.int)
-        for i in range(self._d):
-            if x[i] < self._bounds[i, 0] or x[i] >= self._bounds[i, 1]:
-                print('Value out of bounds! Invalid box returned.')
-                return mind
-            mind[i] = _np.floor((x[i] - self._bounds[i, 0]) / self._h[i])
-        return mind
+        x = _np.asarray(x, dtype=float)
+        X = x.reshape(self._d, -1)
+        lb = self._bounds[:, 0].reshape(-1, 1)
+        ub = self._bounds[:, 1].reshape(-1, 1)
+        valid = _np.all((X >= lb) & (X < ub), axis=0)
+        mind = _np.floor((X - lb) / self._h.reshape(-1, 1)).astype(int)
+        # rounding can put points just below the upper bound into box n
+        mind = _np.minimum(mind, self._boxes.reshape(-1, 1) - 1)
+        mind[:, ~valid] = -1
+        if x.ndim == 1: return mind[:, 0]
+        return mind, valid
 
-    def midpointGrid(self):
+    def midpointAxes(self):
         '''
-        Returns a grid given by the midpoints of the boxes.
+        Returns the midpoint coordinates of the boxes along each dimension.
+        '''
+        if self._midpointAxes is None:
+            b = self._bounds
+            h = self._h
+            self._midpointAxes = [
+                _np.linspace(b[i, 0] + h[i]/2, b[i, 1] - h[i]/2, self._boxes[i]) for i in range(self._d)
+            ]
+        return self._midpointAxes
+
+    def midpoints(self, ind):
+        '''
+        Returns the midpoints of the boxes with indices ind without building the grid.
+        '''
+        mind = indexS2M(_np.asarray(ind).reshape(-1), self._boxes)
+        axes = self.midpointAxes()
+        return _np.array([axes[i][mind[i]] for i in range(self._d)])
+
+    def iterMidpoints(self, chunkSize=65536):
+        '''
+        Yields the midpoints of all boxes in blocks of at most chunkSize columns, in the
+        order of midpointGrid.
         '''
-        b = self._bounds
-        h = self._h
-        d = self._d
         n = self.numBoxes()
-        x = []
-        for i in range(d):
-            x.append( _np.linspace(b[i, 0] + h[i]/2, b[i, 1] - h[i]/2, self._boxes[i]) )
-        X = _sp.meshgrid(*x, indexing='ij')
-        c = _np.zeros([d, n])
-        for i in range(d):
-            c[i, :] = X[i].reshape(n)
-        return c
+        for start in range(0, n, chunkSize):
+            yield self.midpoints(_np.arange(start, min(start + chunkSize, n)))
+
+    def midpointGrid(self):
+        '''
+        Returns a grid given by the midpoints of the boxes (cached, read-only).
+        '''
+        if self._midpointGrid is None:
+            d = self._d
+            n = self.numBoxes()
+            X = _np.meshgrid(*self.midpointAxes(), indexing='ij')
+            c = _np.zeros([d, n])
+            for i in range(d):
+                c[i, :] = X[i].reshape(n)
+            c.setflags(write=False)
+            self._midpointGrid = c
+        return self._midpointGrid
     
     def vertexGrid(self):
         '''
-        Returns a grid given by the vertices.
+        Returns a grid given by the vertices (cached, read-only).
         '''
+        if self._vertexGrid is None:
+            self._vertexGrid = self._buildVertexGrid()
+        return self._vertexGrid
+
+    def _buildVertexGrid(self):
         b = self._bounds
         d = self._d
         n = self.numVertices()
         x = []
         for i in range(d):
             x.append( _np.linspace(b[i, 0], b[i, 1], self._boxes[i]+1) )
-        X = _sp.meshgrid(*x, indexing='ij')
+        X = _np.meshgrid(*x, indexing='ij')
         c = _np.zeros([d, n])
         for i in range(d):
             c[i, :] = X[i].reshape(n)
@@ -132,6 +178,8 @@ class discretization(object):
             ind[i] = [0, self._boxes[i]]
             isBoundary[tuple(ind)] = True
         isBoundary = isBoundary.reshape(n)
+        c.setflags(write=False)
+        isBoundary.setflags(write=False)
         return c, isBoundary
 
     def plot(self, v, mode='2D', grid='midpoint'):
@@ -1,33 +1,35 @@
 #%%
+import os
+import json
+import pickle
+import domain
 import observables
 import numpy as np
 import scipy as sp
-import numba as nb
 import estimate_L
 from scipy import integrate
-from algorithms import learningAlgorithm, rgEDMD#, onlineKoopmanLearning
+from algorithms import learningAlgorithm, BellmanOperator, RecursiveGeneratorEDMD#, onlineKoopmanLearning
+from snapshots import SnapshotBuffer
+from policy import GibbsPolicy, TabulatedPolicy, stateFeatures
+from sampling import samplePolicy
 
 # @nb.njit(fastmath=True)
 # def ln(x):
 #     return np.log(x)
 
-@nb.njit(fastmath=True) #, parallel=True)
-def nb_einsum(A, B):
-    assert A.shape == B.shape
-    res = 0
-    for i in range(A.shape[0]):
-        for j in range(A.shape[1]):
-            res += A[i,j]*B[i,j]
-    return res
-
-@nb.njit(fastmath=True)
-def dpsi(X, nablaPsi, nabla2Psi, k, l, t=1):
-    difference = X[:, l+1] - X[:, l]
-    term_1 = (1/t) * (difference)
-    term_2 = nablaPsi[k, :, l]
-    term_3 = (1/(2*t)) * np.outer(difference, difference)
-    term_4 = nabla2Psi[k, :, :, l]
-    return np.dot(term_1, term_2) #+ nb_einsum(term_3, term_4)
+def dPsiMatrix(X, nablaPsi, nabla2Psi=None, t=1):
+    '''
+    Finite-difference generator lift of all snapshot pairs (X[:, l], X[:, l+1]) at once.
+    The second order term is only added if nabla2Psi is given. The last column is zero.
+    '''
+    difference = (X[:, 1:] - X[:, :-1]) / t
+    dPsi_X = np.zeros((nablaPsi.shape[0], X.shape[1]))
+    dPsi_X[:, :-1] = np.einsum('kdl,dl->kl', nablaPsi[:, :, :-1], difference)
+    if nabla2Psi is not None:
+        dPsi_X[:, :-1] += (t/2) * np.einsum(
+            'kdel,dl,el->kl', nabla2Psi[:, :, :, :-1], difference, difference
+        )
+    return dPsi_X
 
 def rejection_sampler(p, xbounds, pmax):
     while True:
@@ -45,21 +47,79 @@ def sample_cartpole_action(pi, x):
     
     return (y - 0.5 * f1 + 0.5 * f2) / f2
 
+# Version of the directory layout written by GeneratorModel.save
+SAVE_FORMAT_VERSION = 1
+
+def dictionarySpec(psi):
+    '''
+    JSON description of a dictionary from the observables module, None if it has none.
+    '''
+    if isinstance(psi, observables.monomials):
+        return {'type': 'monomials', 'p': int(psi.p)}
+    if isinstance(psi, observables.gaussians):
+        return {
+            'type': 'gaussians',
+            'bounds': psi.Omega._bounds.tolist(),
+            'boxes': psi.Omega._boxes.tolist(),
+            'sigma': float(psi.sigma)
+        }
+    return None
+
+def dictionaryFromSpec(spec):
+    if spec['type'] == 'monomials':
+        return observables.monomials(spec['p'])
+    if spec['type'] == 'gaussians':
+        Omega = domain.discretization(np.array(spec['bounds']), np.array(spec['boxes']))
+        return observables.gaussians(Omega, spec['sigma'])
+    raise ValueError('Unknown dictionary type %s' % spec['type'])
+
 class GeneratorModel:
-    def __init__(self, psi, reward, action_bounds, L=None):
+    def __init__(
+        self, psi, reward, action_bounds, L=None,
+        forgetting=1.0, sqrt_form=False, refactor_every=None, window=None
+    ):
         """
         Create instance of model
 
             Parameters:
                 psi: Set of dictionary functions from the observables class
                 reward: The reward function for whatever problem you are trying to model
+                forgetting: Exponential forgetting factor of the online generator estimate
+                sqrt_form: Propagate a Cholesky factor instead of the inverse in the online updates
+                refactor_every: Number of online updates between re-factorisations
+                window: Keep only the most recent window snapshots (None keeps all of them)
         """
         self.psi = psi
         self.reward = reward
         self.action_bounds = action_bounds
         self.L = L
+        self.forgetting = forgetting
+        self.sqrt_form = sqrt_form
+        self.refactor_every = refactor_every
+        self.window = window
+        # tabulated copy of self.pi, dropped whenever the policy is replaced
+        self.pi_table = None
+        # number of environments in the last update_model_batch
+        self._batch_size = None
+
+    # Snapshot matrices are zero-copy views into preallocated buffers
+    @property
+    def X(self):
+        return self._X.view()
 
-    def fit(self, X, U, timesteps=2, lamb=10):
+    @property
+    def X_tilde(self):
+        return self._X_tilde.view()
+
+    @property
+    def Psi_X_tilde(self):
+        return self._Psi_X_tilde.view()
+
+    @property
+    def dPsi_X_tilde(self):
+        return self._dPsi_X_tilde.view()
+
+    def fit(self, X, U, timesteps=2, lamb=10, tol=None):
         """
         Fits a policy pi to the dataset using Koopman RL
 
@@ -68,50 +128,232 @@ class GeneratorModel:
                 U: Action data
 
         """
-        self.X = X
         self.U = U
         # self.min_action = np.min(U)
         # self.max_action = np.max(U)
 
-        self.X_tilde = np.append(X, [U], axis=0) # extended states
-        self.d = self.X_tilde.shape[0]
-        self.m = self.X_tilde.shape[1]
+        X_tilde = np.append(X, [U], axis=0) # extended states
+        self.d = X_tilde.shape[0]
+        self.m = X_tilde.shape[1]
         # self.s = int(self.d*(self.d+1)/2) # number of second order poly terms
         
-        self.Psi_X_tilde = self.psi(self.X_tilde)
+        Psi_X_tilde = self.psi(X_tilde)
         # self.Psi_X_tilde_T = Psi_X_tilde.T
-        self.k = self.Psi_X_tilde.shape[0]
-        self.nablaPsi = self.psi.diff(self.X_tilde)
-        self.nabla2Psi = self.psi.ddiff(self.X_tilde)
-
-        self.dPsi_X_tilde = np.zeros((self.k, self.m))
-        for row in range(self.k):
-            for column in range(self.m-1):
-                self.dPsi_X_tilde[row, column] = dpsi(
-                    self.X_tilde, self.nablaPsi,
-                    self.nabla2Psi, row, column
-                )
+        self.k = Psi_X_tilde.shape[0]
+
+        # first order generator lift, nabla2Psi is not needed
+        dPsi_X_tilde = dPsiMatrix(X_tilde, self.psi.diff(X_tilde))
         # self.dPsi_X_tilde_T = dPsi_X_tilde.T
 
+        self._X = SnapshotBuffer.fromArray(np.asarray(X, dtype=float), self.window)
+        self._X_tilde = SnapshotBuffer.fromArray(X_tilde.astype(float), self.window)
+        self._Psi_X_tilde = SnapshotBuffer.fromArray(Psi_X_tilde, self.window)
+        self._dPsi_X_tilde = SnapshotBuffer.fromArray(dPsi_X_tilde, self.window)
+
         # L = rrr(Psi_X_tilde_T, dPsi_X_tilde_T)
         self.L = estimate_L.rrr(self.Psi_X_tilde.T, self.dPsi_X_tilde.T)
         # self.L = estimate_L.rrr(self.Psi_X_tilde, self.dPsi_X_tilde)
 
-        self.z_m = np.zeros((self.k, self.k))
-        self.phi_m_inverse = np.linalg.inv(np.identity(self.k))
+        self.rgedmd = RecursiveGeneratorEDMD(
+            self.k, self.forgetting, self.sqrt_form, self.refactor_every
+        )
 
         self.V, self.pi = learningAlgorithm(
             self.L, self.X, self.psi, self.Psi_X_tilde,
             self.action_bounds, self.reward,
-            timesteps=timesteps, lamb=lamb
+            timesteps=timesteps, lamb=lamb, tol=tol
         )
+        self.pi_table = None
+        self._planned_total = self._X.total
+
+    def update_policy(self, timesteps=2, lamb=10, tol=None, warm_start=True):
+        """
+        Re-plans with the current generator estimate
 
-    def update_policy(self, timesteps=2, lamb=10):
+            Parameters:
+                timesteps: Maximum number of value iteration sweeps
+                lamb: Temperature of the Gibbs policy
+                tol: Sup-norm tolerance between successive V that ends the iteration early
+                warm_start: Start from the values of the previous policy instead of zeros
+        """
+        V0 = self.warm_start_values() if warm_start else None
         self.V, self.pi = learningAlgorithm(
             self.L, self.X, self.psi, self.Psi_X_tilde,
             self.action_bounds, self.reward,
-            timesteps=timesteps, lamb=lamb
+            timesteps=timesteps, lamb=lamb, V0=V0, tol=tol
         )
+        self.pi_table = None
+        self._planned_total = self._X.total
+
+    def warm_start_values(self):
+        """
+        Values of the previous policy on the current states, states added since the last
+        plan get their value from the regression of V on the lifted data
+        """
+        V = getattr(self, 'V', None)
+        if V is None: return None
+        Psi_X_tilde = self.Psi_X_tilde
+        # snapshots of the last plan that have left the window since (none without a window)
+        dropped = 0
+        if self.window is not None:
+            dropped = max(0, self._X.total - self.window) - max(0, self._planned_total - self.window)
+        V = V[dropped:]
+        n = V.shape[0]
+        if n <= 0: return None
+        V0 = np.zeros(Psi_X_tilde.shape[1])
+        V0[:n] = V
+        if n < V0.shape[0]:
+            B_v = estimate_L.rrr(Psi_X_tilde[:, :n].T, V.reshape(-1,1))
+            V0[n:] = (B_v.T @ Psi_X_tilde[:, n:])[0]
+        return V0
+
+    def compile_policy(self, n_actions=65, phi=None):
+        """
+        Tabulates the current policy for fast action queries, the table is dropped
+        whenever fit or update_policy replaces the policy
+
+            Parameters:
+                n_actions: Number of points in the uniform action grid
+                phi: State dictionary the table is interpolated in (defaults to psi([x; 0]))
+
+            Returns:
+                pi_table: The tabulated policy, its error_bound is an error estimate on the training states
+        """
+        self._table_settings = (n_actions, phi)
+        if phi is None: phi = stateFeatures(self.psi)
+        self.pi_table = TabulatedPolicy(self.pi, self.X, phi, n_actions)
+        return self.pi_table
+
+    def save(self, path):
+        """
+        Writes the fitted model to a directory of .npy files plus a meta.json
+
+            Parameters:
+                path: Directory to write to (created if missing)
+        """
+        os.makedirs(path, exist_ok=True)
+        spec = dictionarySpec(self.psi)
+        if spec is None:
+            with open(os.path.join(path, 'dictionary.pkl'), 'wb') as f:
+                pickle.dump(self.psi, f)
+
+        meta = {
+            'version': SAVE_FORMAT_VERSION,
+            'dictionary': spec,
+            'action_bounds': [float(bound) for bound in self.action_bounds],
+            'lamb': float(self.pi.lamb),
+            'n_nodes': self.pi.n_nodes,
+            'forgetting': self.forgetting,
+            'sqrt_form': self.sqrt_form,
+            'refactor_every': self.refactor_every,
+            'window': self.window,
+            'num_updates': self.rgedmd.num_updates,
+            'planned_total': self._planned_total,
+            'total': self._X.total,
+            'pi_table': self.pi_table is not None
+        }
+        arrays = {
+            'L': self.L,
+            'coefficients': self.pi.score.coefficients,
+            'V': self.V,
+            'U': np.asarray(self.U),
+            'z_m': self.rgedmd.z_m,
+            'phi_m': self.rgedmd.phi_m,
+            'phi_m_inverse': self.rgedmd._phi_m_inverse,
+            'R': self.rgedmd.R,
+            'X': self.X,
+            'X_tilde': self.X_tilde,
+            'Psi_X_tilde': self.Psi_X_tilde,
+            'dPsi_X_tilde': self.dPsi_X_tilde
+        }
+        if meta['pi_table']:
+            # 'state' for the default psi([x; 0]), None for a custom phi without a spec
+            table_phi = self._table_settings[1]
+            meta['pi_table_phi'] = 'state' if table_phi is None else dictionarySpec(table_phi)
+            meta['pi_table_error_bound'] = float(self.pi_table.error_bound)
+            arrays['pi_table_W'] = self.pi_table.W
+            arrays['pi_table_actions'] = self.pi_table.actions
+            arrays['pi_table_nodes'] = self.pi_table.nodes
+            arrays['pi_table_weights'] = self.pi_table.weights
+
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), np.ascontiguousarray(array))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    @classmethod
+    def load(cls, path, reward, psi=None, mmap_mode='r', phi=None):
+        """
+        Loads a model written by save
+
+            Parameters:
+                path: Directory written by save
+                reward: The reward function (functions are not stored)
+                psi: Dictionary to use instead of the stored one
+                mmap_mode: Memory-map mode for the snapshot matrices (None reads them into memory)
+                phi: State dictionary of the policy table, needed if compile_policy was given
+                    a phi that is not a stored dictionary type
+
+            Returns:
+                model: GeneratorModel ready to sample actions
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != SAVE_FORMAT_VERSION:
+            raise ValueError('Unsupported GeneratorModel format version %s' % meta['version'])
+
+        if psi is None:
+            if meta['dictionary'] is not None:
+                psi = dictionaryFromSpec(meta['dictionary'])
+            else:
+                with open(os.path.join(path, 'dictionary.pkl'), 'rb') as f:
+                    psi = pickle.load(f)
+
+        def load_array(name, mmap=False):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode if mmap else None)
+
+        model = cls(
+            psi, reward, meta['action_bounds'], load_array('L'),
+            meta['forgetting'], meta['sqrt_form'], meta['refactor_every'], meta['window']
+        )
+        model.U = load_array('U')
+        model.V = load_array('V')
+        model._planned_total = meta['planned_total']
+
+        # large snapshot matrices stay memory-mapped until the first update copies them
+        # with a window the buffers also need the number of snapshots that already left it
+        total = meta.get('total')
+        model._X = SnapshotBuffer.wrap(load_array('X', True), model.window, total)
+        model._X_tilde = SnapshotBuffer.wrap(load_array('X_tilde', True), model.window, total)
+        model._Psi_X_tilde = SnapshotBuffer.wrap(load_array('Psi_X_tilde', True), model.window, total)
+        model._dPsi_X_tilde = SnapshotBuffer.wrap(load_array('dPsi_X_tilde', True), model.window, total)
+        model.d, model.m = model.X_tilde.shape
+        model.k = model.Psi_X_tilde.shape[0]
+
+        model.rgedmd = RecursiveGeneratorEDMD(
+            model.k, model.forgetting, model.sqrt_form, model.refactor_every
+        )
+        model.rgedmd.z_m = load_array('z_m')
+        model.rgedmd.phi_m = load_array('phi_m')
+        model.rgedmd._phi_m_inverse = load_array('phi_m_inverse')
+        model.rgedmd.R = load_array('R')
+        model.rgedmd.num_updates = meta['num_updates']
+
+        bellman = BellmanOperator(load_array('coefficients'), psi, reward)
+        model.pi = GibbsPolicy(bellman, model.action_bounds, meta['lamb'], meta['n_nodes'])
+        if meta['pi_table']:
+            table_phi = meta.get('pi_table_phi', 'state')
+            if phi is None and table_phi is None:
+                raise ValueError('The policy table was compiled with a custom phi, pass it to load')
+            if phi is None and table_phi != 'state': phi = dictionaryFromSpec(table_phi)
+            actions = load_array('pi_table_actions')
+            model._table_settings = (actions.shape[0], phi)
+            model.pi_table = TabulatedPolicy.fromArrays(
+                load_array('pi_table_W'), actions,
+                load_array('pi_table_nodes'), load_array('pi_table_weights'),
+                meta['lamb'], stateFeatures(psi) if phi is None else phi, meta['pi_table_error_bound']
+            )
+        return model
 
     def update_model(self, x, u, update_policy=False):
         """
@@ -122,30 +364,78 @@ class GeneratorModel:
                 u: A single action vector
         """
         x = x.reshape(-1,1)
-        self.X = np.append(self.X, x, axis=1)
+        self._X.append(x)
+        self._batch_size = None
 
         x_tilde = np.append(x, u).reshape(-1,1)
-        self.X_tilde = np.append(self.X_tilde, x_tilde, axis=1)
+        self._X_tilde.append(x_tilde)
+
+        self._Psi_X_tilde.append(self.psi(x_tilde))
+        last_pair = self.X_tilde[:, -2:]
+        dPsi_x_tilde = dPsiMatrix(last_pair, self.psi.diff(last_pair))[:, 0]
+        self._dPsi_X_tilde.append(np.zeros(self.k))
+        self._dPsi_X_tilde.set_column(-2, dPsi_x_tilde)
 
-        self.Psi_X_tilde = np.append(self.Psi_X_tilde, self.psi(x_tilde), axis=1)
-        k = self.dPsi_X_tilde.shape[0]
-        for l in range(k):
-            self.dPsi_X_tilde[l, -1] = dpsi(
-                self.X_tilde, self.nablaPsi, self.nabla2Psi, l, -2
+        # dPsi_X_tilde[:,-2] is now complete, it belongs to the snapshot in Psi_X_tilde[:,-2]
+        self.L = self.rgedmd.update(self.dPsi_X_tilde[:,-2:-1], self.Psi_X_tilde[:,-2:-1])
+
+        if update_policy: self.update_policy()
+
+    def update_model_batch(self, X_batch, U_batch, update_policy=False):
+        """
+        Appends one snapshot per parallel environment copy and updates the generator
+        estimate with a single recursive EDMD block update. Column j must belong to the
+        same environment in every call: its derivative is taken from column j of the
+        next batch, so the update uses the snapshots of the previous batch. Forgetting
+        is applied once per batch (one tick of all environments)
+
+            Parameters:
+                X_batch: [d, b] matrix of states, one column per environment
+                U_batch: b actions
+        """
+        X_batch = np.asarray(X_batch, dtype=float).reshape(self.d - 1, -1)
+        b = X_batch.shape[1]
+        # the previous batch has to stay in the window until its derivatives are known
+        if self.window is not None and 2 * b > self.window:
+            raise ValueError(
+                'A batch of %d environments needs a window of at least %d snapshots' % (b, 2 * b)
             )
-        self.dPsi_X_tilde = np.append(self.dPsi_X_tilde, np.zeros((k,1)), axis=1)
+        X_tilde_batch = np.append(X_batch, np.asarray(U_batch, dtype=float).reshape(1, b), axis=0)
+        completes_previous = self._batch_size == b
 
-        Psi_X_tilde_m = self.Psi_X_tilde[:,-1].reshape(-1,1)
+        self._X.extend(X_batch)
+        self._X_tilde.extend(X_tilde_batch)
+        self._Psi_X_tilde.extend(self.psi(X_tilde_batch))
+        self._dPsi_X_tilde.extend(np.zeros((self.k, b)))
+        self._batch_size = b
 
-        self.z_m, self.phi_m_inverse, self.L = rgEDMD(
-            self.dPsi_X_tilde,
-            Psi_X_tilde_m,
-            self.z_m,
-            self.phi_m_inverse
-        )
+        if completes_previous:
+            # first order lift of dPsiMatrix, differenced environment by environment
+            previous = self.X_tilde[:, -2*b:-b]
+            dPsi_previous = np.einsum(
+                'kdl,dl->kl', self.psi.diff(previous), X_tilde_batch - previous
+            )
+            self._dPsi_X_tilde.set_columns(-2*b, dPsi_previous)
+            self.L = self.rgedmd.update(dPsi_previous, self.Psi_X_tilde[:, -2*b:-b])
 
         if update_policy: self.update_policy()
 
+    def sample_actions(self, X_batch, rng=None):
+        """
+        Samples one action per state from the tabulated policy. The table is recompiled
+        from the current policy (with the last compile_policy settings) after a re-plan
+
+            Parameters:
+                X_batch: [d, b] matrix of states
+                rng: numpy Generator
+
+            Returns:
+                actions: b sampled actions
+        """
+        if self.pi_table is None: self.compile_policy(*getattr(self, '_table_settings', ()))
+        X_batch = np.asarray(X_batch, dtype=float).reshape(self.d - 1, -1)
+        return samplePolicy(self.pi_table, X_batch, rng=rng)[:, 0]
+
     def sample_action(self, x):
         """
         Sample action from policy pi
@@ -156,6 +446,8 @@ class GeneratorModel:
             Returns:
                 action: Action sampled from estimated optimal policy pi
         """
+        if self.pi_table is not None:
+            return samplePolicy(self.pi_table, x.reshape(-1,1))[0,0]
         return sample_cartpole_action(self.pi, x)
 
         # Attempt at taylor approximation sampling
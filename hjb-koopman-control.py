@@ -4,23 +4,16 @@ import numpy as np
 import scipy as sp
 import quadpy as qp
 import numba as nb
-import mpmath as mp
 from scipy import integrate
 from scipy import linalg
 from estimate_L import rrr
 from control import lqr
+from policy import GibbsPolicy
 
 @nb.njit(fastmath=True)
 def ln(x):
     return np.log(x)
 
-def mpexp(X):
-    if np.isscalar(X): return float(mp.exp(X))
-    output = []
-    for x in X:
-        output.append(float(mp.exp(x)))
-    return output
-
 #%% Dictionary functions
 psi = observables.monomials(6)
 
@@ -96,7 +89,6 @@ def learningAlgorithm(X, psi, Psi_X, action_bounds, reward, timesteps=4, cutoff=
     n = Psi_X.shape[0]
     d = X.shape[0]
     low, high = action_bounds
-    constant = 1/lamb
 
     # V^{\pi*_0}
     currentV = np.zeros((1, X.shape[1]))
@@ -114,19 +106,20 @@ def learningAlgorithm(X, psi, Psi_X, action_bounds, reward, timesteps=4, cutoff=
             dy_dt = K @ y + D_y * u
             return ((nablaPsi_x.T @ B).T @ F @ dy_dt)[0,0]
 
-        @nb.jit(forceobj=True, fastmath=True)
-        def compute(u, x):
-            inner = constant * (reward(x, u) + Lv_hat(x, u))
-            return mpexp(inner)
+        def score(X_batch, U_batch):
+            nablaPsi_X = psi.diff(X_batch)
+            Y_batch = np.append(X_batch, [X_batch[0]**2], axis=0)
+            dY_dt = K @ Y_batch + D_y * U_batch
+            Lv = np.einsum('n,ndb,db->b', B[:,0], nablaPsi_X, F @ dY_dt)
+            return np.array([reward(x, u) for x, u in zip(X_batch.T, U_batch)]) + Lv
 
-        def pi_hat_star(u, x): # action given state
-            numerator = compute(u, x)
-            denominator = qp.quad(compute, low, high, args=(x,))[0]
-            return numerator / denominator
+        # action given state, caches the normalising integral per state
+        pi_hat_star = GibbsPolicy(score, action_bounds, lamb)
 
         def compute_2(u, x):
-            eval_pi_hat_star = pi_hat_star(u, x)
-            return (reward(x, u) - (lamb * ln(eval_pi_hat_star)) + Lv_hat(x, u)) * eval_pi_hat_star
+            log_pi = pi_hat_star.log_pi(u, x)
+            if np.isscalar(u): log_pi = log_pi[0]
+            return (reward(x, u) - (lamb * log_pi) + Lv_hat(x, u)) * np.exp(log_pi)
 
         def V(x):
             return qp.quad(compute_2, low, high, args=(x,))[0]
@@ -235,7 +228,6 @@ def learningAlgorithm(X, psi, Psi_X, action_bounds, reward, timesteps=4, cutoff=
     n = Psi_X.shape[0]
     d = X.shape[0]
     low, high = action_bounds
-    constant = 1/lamb
 
     # V^{\pi*_0}
     currentV = np.zeros((1, X.shape[1]))
@@ -253,19 +245,20 @@ def learningAlgorithm(X, psi, Psi_X, action_bounds, reward, timesteps=4, cutoff=
             dy_dt = K @ y + D_y * u
             return ((nablaPsi_x.T @ B).T @ F @ dy_dt)[0,0]
 
-        @nb.jit(forceobj=True, fastmath=True)
-        def compute(u, x):
-            inner = constant * (reward(x, u) + Lv_hat(x, u))
-            return mpexp(inner)
+        def score(X_batch, U_batch):
+            nablaPsi_X = psi.diff(X_batch)
+            Y_batch = np.append(X_batch, [X_batch[0]**2], axis=0)
+            dY_dt = K @ Y_batch + D_y * U_batch
+            Lv = np.einsum('n,ndb,db->b', B[:,0], nablaPsi_X, F @ dY_dt)
+            return np.array([reward(x, u) for x, u in zip(X_batch.T, U_batch)]) + Lv
 
-        def pi_hat_star(u, x): # action given state
-            numerator = compute(u, x)
-            denominator = qp.quad(compute, low, high, args=(x,))[0]
-            return numerator / denominator
+        # action given state, caches the normalising integral per state
+        pi_hat_star = GibbsPolicy(score, action_bounds, lamb)
 
         def compute_2(u, x):
-            eval_pi_hat_star = pi_hat_star(u, x)
-            return (reward(x, u) - (lamb * ln(eval_pi_hat_star)) + Lv_hat(x, u)) * eval_pi_hat_star
+            log_pi = pi_hat_star.log_pi(u, x)
+            if np.isscalar(u): log_pi = log_pi[0]
+            return (reward(x, u) - (lamb * log_pi) + Lv_hat(x, u)) * np.exp(log_pi)
 
         def V(x):
             return qp.quad(compute_2, low, high, args=(x,))[0]
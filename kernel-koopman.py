@@ -4,6 +4,7 @@ import gym
 import numpy as np
 import numba as nb
 import matplotlib.pyplot as plt
+from rollout import rollout, horizonErrors
 
 #%% Import and process data
 X = np.load('random-agent/cartpole-states.npy').T
@@ -75,6 +76,11 @@ def model(x, threshold=thresh):
         predicted_state += np.real(d[k] * koopman_modes[k] * eigenfunction(k, x))
     return predicted_state.reshape(-1,1)
 
+def batchModel(X_batch, threshold=thresh):
+    # eigenfunction values of all states at once, [n, threshold]
+    eigenfunctions = kernel(X_batch.T, X.T) @ (Q @ Sigma_pinv @ V_hat[:,:threshold])
+    return np.real((eigenfunctions * d[:threshold]) @ koopman_modes[:threshold]).T
+
 #%% One-step prediction error
 title = "One-step prediction error:"
 print(title)
@@ -111,22 +117,18 @@ print(title)
 env = gym.make('CartPole-v0')
 horizon = 1000
 num_trials = 10#00
-norms = []
+action_paths = np.random.choice([0,1], size=(num_trials, horizon))
+initial_states = np.empty((state_dim, num_trials))
+true_trajectories = np.empty((horizon, state_dim, num_trials))
 for i in range(num_trials):
-    action_path = [np.random.choice([0,1]) for i in range(horizon)]
-    trial_norms = []
-    true_state = env.reset()
-    predicted_state = true_state.copy()
-    # vector_field_array = [true_state]
+    initial_states[:,i] = env.reset()
     for h in range(horizon):
-        action = action_path[h]
-        predicted_state = model(predicted_state)
-        true_state = (env.step(action)[0]).reshape(-1,1)
-        # vector_field_array.append(predicted_state.reshape(state_dim))
-        norm = auxiliaries.l2_norm(true_state, predicted_state)/auxiliaries.l2_norm(true_state, 0)
-        trial_norms.append(norm)
-    # vector_field_arrays.append(vector_field_array)
-    norms.append(trial_norms)
+        true_trajectories[h,:,i] = env.step(action_paths[i,h])[0]
+
+# the kernel model does not depend on the action, all trials are predicted together
+predicted_trajectories = rollout(lambda X_batch, u: batchModel(X_batch), initial_states, action_paths)
+norms, stats = horizonErrors(true_trajectories, predicted_trajectories[1:])
+norms = norms.T
 
 # vector_field_arrays = np.array(vector_field_arrays)
 # X_plot = vector_field_arrays[:,:,0].reshape((horizon * num_trials)+1) # cart pos
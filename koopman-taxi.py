@@ -2,7 +2,9 @@
 import gym
 import numpy as np
 import estimate_L
+import observables
 import algorithmsv2
+from koopman_tensor import CountKoopmanTensor, KoopmanTensor, tensorEDMD
 env = gym.make("Taxi-v3")
 
 def l2_norm(true_state, predicted_state):
@@ -54,13 +56,11 @@ def cost(x, u):
     return -reward(x, u)
 
 #%% Koopman tensor EDMD setup
-def phi(x):
-    phi_x = np.zeros(enumerated_states.shape[0])
+# one-hot index is the mixed-radix code of the state, same layout as env.encode
+state_dictionary = observables.onehots((num_rows, num_cols, num_locations, num_destinations))
 
-    for i,state in enumerate(enumerated_states):
-        if np.array_equal(x, state):
-            phi_x[i] = 1
-            return phi_x
+def phi(x):
+    return state_dictionary(np.asarray(x).reshape(-1,1))[:,0]
 
 def psi(u):
     psi_u = np.zeros(num_unique_actions)
@@ -68,11 +68,7 @@ def psi(u):
     return psi_u
 
 def getPhiMatrix(X):
-    Phi_X = []
-    for x in X.T:
-        Phi_X.append(phi(x))
-
-    return np.array(Phi_X).T
+    return state_dictionary(X)
 
 def getPsiMatrix(U):
     Psi_U = []
@@ -92,32 +88,24 @@ num_lifted_state_features = Phi_X.shape[0]
 num_lifted_action_observations = Psi_U.shape[1]
 num_lifted_action_features = Psi_U.shape[0]
 
-# @nb.njit(fastmath=True)
-def getPsiPhiMatrix(Psi_U, Phi_X):
-    psiPhiMatrix = np.empty((num_lifted_action_features * num_lifted_state_features, num_lifted_state_observations))
-
-    for i in range(num_lifted_state_observations):
-        kron = np.kron(Psi_U[:,i], Phi_X[:,i])
-        psiPhiMatrix[:,i] = kron
-
-    return psiPhiMatrix
-
-psiPhiMatrix = getPsiPhiMatrix(Psi_U, Phi_X)
-print("PsiPhiMatrix shape:", psiPhiMatrix.shape)
-
-#%% Compute M as in writeup
-M = estimate_L.rrr(psiPhiMatrix.T, getPhiMatrix(Y).T).T
+#%% Compute M as in writeup, from the normal equations without forming the kron features
+M = tensorEDMD(Phi_X, Psi_U, getPhiMatrix(Y), rank=8)
 print("M shape:", M.shape)
 assert M.shape == (num_lifted_state_features, num_lifted_state_features * num_lifted_action_features)
 
-#%% Reshape M into Koopman tensor
-K = np.empty((num_lifted_state_features, num_lifted_state_features, num_lifted_action_features))
-for i in range(M.shape[0]):
-    K[i] = M[i].reshape((num_lifted_state_features, num_lifted_action_features))
+#%% View M as the Koopman tensor, K_u cached for every action
+tensor = KoopmanTensor.fromM(M, psi, enumerated_actions[:,0])
+K = tensor.K
 print("K shape:", K.shape)
+# K[i, j, z] = M[i, z*k + j] is a view of M, matching the kron(psi, phi) feature order
+assert np.shares_memory(K, M)
+assert np.allclose(tensor.K_u(U[0,0]) @ Phi_X[:,0], M @ np.kron(Psi_U[:,0], Phi_X[:,0]))
 
-def K_u(K, u):
-    return np.einsum('ijz,z->ij', K, psi(u))
+#%% Exact least-squares tensor of the one-hot dictionaries from transition counts
+# (the last column of Y is padding)
+count_tensor = CountKoopmanTensor(state_dictionary.numStates(), num_unique_actions).update(
+    state_dictionary.encode(X[:,:-1]), U[0,:-1], state_dictionary.encode(Y[:,:-1])
+)
 
 #%% Test prediction error
 episodes = 1
@@ -133,8 +121,8 @@ for episode in range(episodes):
         print("Action:", action)
 
         print("Decoded state:", decoded_true_state)
-        phi_x_prime = K_u(K, action) @ phi(decoded_true_state)
-        predicted_state = enumerated_states[np.argmax(phi_x_prime)]
+        phi_x_prime = count_tensor.K_u(action) @ phi(decoded_true_state)
+        predicted_state = state_dictionary.decodeArgmax(phi_x_prime.reshape(-1,1))[:,0]
         print("Predicted state:", predicted_state)
         true_state, _, done, __ = env.step(action)
 
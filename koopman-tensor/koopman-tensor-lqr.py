@@ -10,6 +10,7 @@ sys.path.append("../")
 import estimate_L
 import auxiliaries
 import algorithmsv2
+from koopman_tensor import KoopmanTensor, tensorEDMD
 
 from control import lqr
 from scipy import integrate
@@ -138,30 +139,19 @@ num_lifted_state_features = Phi_X.shape[0]
 num_lifted_action_observations = Psi_U.shape[1]
 num_lifted_action_features = Psi_U.shape[0]
 
-# @nb.njit(fastmath=True)
-def getPsiPhiMatrix(Psi_U, Phi_X):
-    psiPhiMatrix = np.empty((num_lifted_action_features * num_lifted_state_features, num_lifted_state_observations))
-
-    for i in range(num_lifted_state_observations):
-        kron = np.kron(Psi_U[:,i], Phi_X[:,i])
-        psiPhiMatrix[:,i] = kron
-
-    return psiPhiMatrix
-
 #%%
-psiPhiMatrix = getPsiPhiMatrix(Psi_U, Phi_X)
-print("PsiPhiMatrix shape:", psiPhiMatrix.shape)
-M = estimate_L.ols(psiPhiMatrix.T, getPhiMatrix(Y_opt).T).T
+M = tensorEDMD(Phi_X, Psi_U, getPhiMatrix(Y_opt))
 print("M shape:", M.shape)
 assert M.shape == (num_lifted_state_features, num_lifted_state_features * num_lifted_action_features)
 
-K = np.empty((num_lifted_state_features, num_lifted_state_features, num_lifted_action_features))
-for i in range(M.shape[0]):
-    K[i] = M[i].reshape((num_lifted_state_features, num_lifted_action_features), order='F')
+# continuous actions, so K_u is contracted per call and predictions run batched
+tensor = KoopmanTensor.fromM(M, psi)
+K = tensor.K
+K_u = tensor.K_u
 print("K shape:", K.shape)
-
-def K_u(u):
-    return np.einsum('ijz,z->ij', K, psi(u))
+# K[i, j, z] = M[i, z*k + j] is a view of M, matching the kron(psi, phi) feature order
+assert np.shares_memory(K, M)
+assert np.allclose(tensor.K_u(U_opt[0,0]) @ Phi_X[:,0], M @ np.kron(Psi_U[:,0], Phi_X[:,0]))
 
 print("Psi U[0,0]:", psi(U_opt[0,0]))
 print("K_u shape:", K_u(U_opt[0,0]).shape)
@@ -171,26 +161,13 @@ def l2_norm(true_state, predicted_state):
     return np.sum( np.power( ( true_state - predicted_state ), 2 ) )
 
 #%% Training error
-norms = []
-starting_point = 0
-for i in range(Y_opt.shape[1]):
-    actual_phi_x_prime = phi(Y_opt[:,starting_point+i])
-    predicted_phi_x_prime = K_u(U_opt[0,starting_point+i]) @ phi(X_opt[:,starting_point+i])
-
-    norms.append(l2_norm(actual_phi_x_prime, predicted_phi_x_prime))
-norms = np.array(norms)
+Phi_Y_opt = getPhiMatrix(Y_opt)
+norms = np.sum(np.power(Phi_Y_opt - tensor.predict(Phi_X, U_opt[0]), 2), axis=0)
 # print(norms)
 print("Mean training norm:", norms.mean())
 
 #%% Single-step prediction error with optimal controller
-norms = []
-starting_point = 0
-for i in range(Y_opt.shape[1]):
-    actual_phi_x_prime = phi(Y_opt[:,starting_point+i])
-    predicted_phi_x_prime = K_u(U_opt[0,starting_point+i]) @ phi(X_opt[:,starting_point+i])
-
-    norms.append(l2_norm(actual_phi_x_prime, predicted_phi_x_prime))
-norms = np.array(norms)
+norms = np.sum(np.power(Phi_Y_opt - tensor.predict(Phi_X, U_opt[0]), 2), axis=0)
 print("Mean single-step prediction norm:", norms.mean())
 
 #%%
\ No newline at end of file
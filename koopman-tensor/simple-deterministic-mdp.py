@@ -28,6 +28,7 @@ import numpy as np
 import sys
 sys.path.append('../')
 import estimate_L
+from koopman_tensor import CountKoopmanTensor, KoopmanTensor, tensorEDMD
 
 def f(x, u):
     if x == 0:
@@ -105,32 +106,17 @@ Psi_U = np.empty((d_psi,N))
 for i,u in enumerate(U.T):
     Psi_U[:,i] = psi(int(u[0]))[:,0]
 
-#%% Build kronMatrix
-kronMatrix = np.empty((d_psi * d_phi, N))
-for i in range(N):
-    kronMatrix[:,i] = np.kron(Psi_U[:,i], Phi_X[:,i])
-
-#%% Estimate M
-M =  estimate_L.ols(kronMatrix.T, Phi_Y.T).T
-
-#%% Reshape M into K tensor
-K = np.empty((d_phi, d_phi, d_psi))
-for i in range(d_phi):
-    K[i] = M[i].reshape((d_phi,d_psi), order='F')
-
-def K_u(K, u):
-    return np.einsum('ijz,z->ij', K, psi(u)[:,0])
+#%% Count transitions, the least-squares tensor for one-hot dictionaries
+tensor = CountKoopmanTensor(d_phi, d_psi).update(X[0], U[0], Y[0])
+K = tensor.K
+# same tensor as the least-squares fit on the kron(psi, phi) features
+assert np.allclose(K, KoopmanTensor.fromM(tensorEDMD(Phi_X, Psi_U, Phi_Y), lambda u: psi(int(u))).K)
 
 #%% Training error
 def l2_norm(true_state, predicted_state):
     return np.sum( np.power( ( true_state - predicted_state ), 2 ) )
 
-norms = []
-for i in range(N):
-    true_phi_x_prime = Phi_Y[:,i]
-    predicted_phi_x_prime = K_u(K, int(U[0,i])) @ Phi_X[:,i]
-    norms.append(l2_norm(true_phi_x_prime, predicted_phi_x_prime))
-norms = np.array(norms)
+norms = np.sum(np.power(Phi_Y - tensor.predict(Phi_X, U[0]), 2), axis=0)
 
 print("Mean norm on training data:", norms.mean())
 
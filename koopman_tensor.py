@@ -0,0 +1,292 @@
+#%%
+import numpy as np
+from scipy import sparse
+from multi_model import partition_by_action
+
+def liftActions(psi, U):
+    '''
+    [z, b] matrix of psi(u) for the b actions in U (psi may return [z] or [z, 1]).
+    '''
+    return np.array([np.ravel(psi(u)) for u in U]).T
+
+def khatriRao(Psi_U, Phi_X):
+    '''
+    Column-wise Kronecker product, column n is np.kron(Psi_U[:, n], Phi_X[:, n]).
+    '''
+    return (Psi_U[:, None, :] * Phi_X[None, :, :]).reshape(-1, Phi_X.shape[1])
+
+class TensorEDMD(object):
+    '''
+    Streaming normal equations of tensor EDMD, Phi_Y ~ M (Psi_U khatri-rao Phi_X).
+
+    update accumulates the [k*z, k*z] Gram G = sum_n (psi psi^T) kron (phi phi^T) and the
+    [k, k*z] cross term C = sum_n phi(y) kron(psi, phi)^T chunk by chunk, so the full
+    kron feature matrix is never formed. solve returns the same M as estimate_L.ols or,
+    with a rank, estimate_L.rrr on that matrix.
+    '''
+
+    def __init__(self, k, z, chunk_size=4096):
+        self.k = k
+        self.z = z
+        self.chunk_size = chunk_size
+        self.G = np.zeros((k*z, k*z))
+        self.C = np.zeros((k, k*z))
+        self.num_snapshots = 0
+
+    def update(self, Phi_X, Psi_U, Phi_Y):
+        for start in range(0, Phi_X.shape[1], self.chunk_size):
+            end = start + self.chunk_size
+            kron = khatriRao(Psi_U[:, start:end], Phi_X[:, start:end])
+            self.G += kron @ kron.T
+            self.C += Phi_Y[:, start:end] @ kron.T
+        self.num_snapshots += Phi_X.shape[1]
+        return self
+
+    def solve(self, rank=None):
+        '''
+        M as a C-contiguous [k, k*z] matrix, reduced rank regression if rank is given.
+        '''
+        # M = B_ols.T, G is symmetric
+        M = self.C @ np.linalg.pinv(self.G, hermitian=True)
+        if rank is None: return M
+        # estimate_L.rrr with Y.T X = C, M_rr = (B_ols W W^T).T
+        V = np.linalg.svd(self.C @ M.T)[2]
+        W = V[0:rank].T
+        return W @ (W.T @ M)
+
+def tensorEDMD(Phi_X, Psi_U, Phi_Y, rank=None, chunk_size=4096):
+    '''
+    Fits the [k, k*z] matrix M of a Koopman tensor from lifted states, actions and next states.
+    '''
+    solver = TensorEDMD(Phi_X.shape[0], Psi_U.shape[0], chunk_size)
+    return solver.update(Phi_X, Psi_U, Phi_Y).solve(rank)
+
+class KoopmanTensor(object):
+    '''
+    Koopman tensor K[i, j, z] with K_u = sum_z K[:, :, z] psi(u)[z].
+
+    If actions are given, K_u is contracted once for each of them and cached as K_U[a].
+    With grid=True the actions are a uniform grid and K_u of an action in between two
+    grid points is linearly interpolated (exact when psi is affine in u). Without actions
+    K_u is contracted on every call.
+
+    Axis convention: the columns of the regression matrix M follow np.kron(psi(u), phi(x)),
+    so K[i, j, z] = M[i, z*k + j]. fromM wraps M as a strided view with these axes
+    (this is M[i].reshape((k, z), order='F') for every row, without copying).
+    '''
+
+    def __init__(self, K, psi, actions=None, grid=False):
+        self.K = K
+        self.M = None
+        self.psi = psi
+        self.grid = grid
+        self.actions = None
+        self.K_U = None
+        if actions is not None:
+            self.actions = np.asarray(actions).reshape(-1)
+            # [A, k, k], K_U[a] is K_u for the action actions[a]
+            self.K_U = np.einsum('ijz,za->aij', K, liftActions(psi, self.actions))
+            self._order = np.argsort(self.actions, kind='stable')
+            if grid: self.h = self.actions[1] - self.actions[0]
+
+    @classmethod
+    def fromM(cls, M, psi, actions=None, grid=False):
+        '''
+        Koopman tensor whose K is a view of the [k, k*z] matrix M (copied once only if M
+        is not C-contiguous).
+        '''
+        M = np.ascontiguousarray(M)
+        k = M.shape[0]
+        # [i, z, j] view of the rows, then swap the last two axes
+        K = M.reshape(k, -1, k).transpose(0, 2, 1)
+        tensor = cls(K, psi, actions, grid)
+        tensor.M = M
+        return tensor
+
+    def action_index(self, U):
+        '''
+        Cache indices of the actions U, plus the interpolation weights of the next grid
+        point if grid=True (None otherwise).
+        '''
+        U = np.asarray(U).reshape(-1)
+        if self.grid:
+            position = (np.clip(U, self.actions[0], self.actions[-1]) - self.actions[0]) / self.h
+            inds = np.minimum(position.astype(int), self.actions.shape[0] - 2)
+            return inds, position - inds
+
+        sorted_actions = self.actions[self._order]
+        positions = np.minimum(np.searchsorted(sorted_actions, U), sorted_actions.shape[0] - 1)
+        if not np.all(sorted_actions[positions] == U):
+            raise ValueError('Actions not in the cached action set')
+        return self._order[positions], None
+
+    def K_u(self, u):
+        if self.K_U is None:
+            return np.einsum('ijz,z->ij', self.K, np.ravel(self.psi(u)))
+        inds, t = self.action_index(u)
+        if t is None: return self.K_U[inds[0]]
+        return (1 - t[0]) * self.K_U[inds[0]] + t[0] * self.K_U[inds[0]+1]
+
+    def predict(self, Phi_X, U):
+        '''
+        One-step prediction K_u phi(x) for every column of the [k, b] matrix Phi_X and its
+        action in U. With a cache this is one matmul per action that occurs in U, without
+        it one per action feature, so the [k*z, b] kron features are never formed.
+        '''
+        if self.K_U is None:
+            Psi_U = liftActions(self.psi, U)
+            Phi_Y = np.zeros((self.K.shape[0], Phi_X.shape[1]))
+            for z in range(Psi_U.shape[0]):
+                Phi_Y += self.K[:, :, z] @ (Phi_X * Psi_U[z])
+            return Phi_Y
+
+        inds, t = self.action_index(U)
+        Phi_Y = np.zeros((self.K_U.shape[1], Phi_X.shape[1]))
+        if t is None:
+            self._accumulate(Phi_Y, Phi_X, inds)
+        else:
+            self._accumulate(Phi_Y, Phi_X * (1 - t), inds)
+            self._accumulate(Phi_Y, Phi_X * t, inds + 1)
+        return Phi_Y
+
+    def _accumulate(self, Phi_Y, Phi_X, inds):
+        # group the columns by action so each cached K_u is applied once
+        for a, cols in enumerate(partition_by_action(inds, self.K_U.shape[0])):
+            if cols.shape[0] > 0:
+                Phi_Y[:, cols] += self.K_U[a] @ Phi_X[:, cols]
+
+class CountKoopmanTensor(object):
+    '''
+    Koopman tensor of a finite MDP with one-hot state and action dictionaries.
+
+    For one-hot dictionaries the least-squares tensor is the empirical transition matrix
+    of each action, K_u[i, j] = #(j, u -> i) / #(j, u) (zero columns for pairs never
+    visited, as with the pseudo-inverse). Transitions are counted into a sparse
+    [A*n, n] matrix in one pass, update can be called again with new data, and
+    K_u / predict follow the KoopmanTensor API with states and actions given as indices
+    (see observables.onehots.encode).
+    '''
+
+    def __init__(self, num_states, num_actions):
+        self.num_states = num_states
+        self.num_actions = num_actions
+        self.counts = sparse.csr_matrix((num_actions * num_states, num_states))
+        self.visits = np.zeros((num_actions, num_states))
+        self._K_U = None
+
+    def update(self, X, U, Y):
+        '''
+        Adds the transitions (X[n], U[n]) -> Y[n], all given as indices.
+        '''
+        X, U, Y = (np.asarray(A, dtype=int).reshape(-1) for A in (X, U, Y))
+        n = self.num_states
+        self.counts = self.counts + sparse.csr_matrix(
+            (np.ones(X.shape[0]), (U * n + Y, X)), shape=self.counts.shape
+        )
+        self.visits += np.bincount(U * n + X, minlength=self.visits.size).reshape(self.visits.shape)
+        self._K_U = None
+        return self
+
+    @property
+    def K_U(self):
+        '''
+        Sparse [n, n] K_u for every action, recomputed after an update.
+        '''
+        if self._K_U is None:
+            n = self.num_states
+            with np.errstate(divide='ignore'):
+                inverse_visits = np.where(self.visits > 0, 1 / self.visits, 0)
+            self._K_U = [
+                (self.counts[u*n:(u+1)*n] @ sparse.diags(inverse_visits[u])).tocsr()
+                for u in range(self.num_actions)
+            ]
+        return self._K_U
+
+    @property
+    def K(self):
+        '''
+        Dense [n, n, A] tensor, K[i, j, u] = K_u[i, j].
+        '''
+        return np.stack([K_u.toarray() for K_u in self.K_U], axis=2)
+
+    def K_u(self, u):
+        return self.K_U[int(u)]
+
+    def predict(self, Phi_X, U):
+        '''
+        K_u phi(x) for every column of the [n, b] matrix Phi_X and its action index in U.
+        '''
+        Phi_Y = np.zeros((self.num_states, Phi_X.shape[1]))
+        for u, cols in enumerate(partition_by_action(U, self.num_actions)):
+            if cols.shape[0] > 0:
+                Phi_Y[:, cols] = self.K_U[u] @ Phi_X[:, cols]
+        return Phi_Y
+
+def _leadingVectors(A, rank):
+    # leading left singular vectors of A from its (smaller) Gram matrix
+    values, vectors = np.linalg.eigh(A @ A.T)
+    return vectors[:, ::-1][:, :rank]
+
+class TuckerKoopmanTensor(object):
+    '''
+    Low-rank Koopman tensor K[i, j, z] = sum_abc G[a, b, c] U1[i, a] U2[j, b] U3[z, c].
+
+    Fit by truncating the unfoldings of K (the M matrix is the mode-1 unfolding) and
+    optionally refined by n_iter sweeps of alternating least squares (HOOI). predict
+    contracts through the factors, O(r (d_phi + d_psi) + r^3) per sample, and never forms
+    K or K_u. ranks is one rank for every mode or (r_i, r_j, r_z).
+    '''
+
+    def __init__(self, U1, U2, U3, G, psi):
+        self.U1, self.U2, self.U3 = U1, U2, U3
+        self.G = G
+        self.psi = psi
+
+    @classmethod
+    def fromTensor(cls, K, psi, ranks, n_iter=0):
+        if np.isscalar(ranks): ranks = (ranks, ranks, ranks)
+        ranks = [min(r, n) for r, n in zip(ranks, K.shape)]
+        unfoldings = [
+            lambda T: T.reshape(T.shape[0], -1),
+            lambda T: T.transpose(1, 0, 2).reshape(T.shape[1], -1),
+            lambda T: T.transpose(2, 0, 1).reshape(T.shape[2], -1)
+        ]
+        factors = [_leadingVectors(unfold(K), r) for unfold, r in zip(unfoldings, ranks)]
+
+        for _ in range(n_iter):
+            U1, U2, U3 = factors
+            factors[0] = _leadingVectors(unfoldings[0](np.einsum('ijz,jb,zc->ibc', K, U2, U3)), ranks[0])
+            U1 = factors[0]
+            factors[1] = _leadingVectors(unfoldings[1](np.einsum('ijz,ia,zc->ajc', K, U1, U3)), ranks[1])
+            U2 = factors[1]
+            factors[2] = _leadingVectors(unfoldings[2](np.einsum('ijz,ia,jb->abz', K, U1, U2)), ranks[2])
+
+        U1, U2, U3 = factors
+        G = np.einsum('ijz,ia,jb,zc->abc', K, U1, U2, U3, optimize=True)
+        return cls(U1, U2, U3, G, psi)
+
+    @classmethod
+    def fromM(cls, M, psi, ranks, n_iter=0):
+        return cls.fromTensor(KoopmanTensor.fromM(M, psi).K, psi, ranks, n_iter)
+
+    @property
+    def ranks(self):
+        return self.G.shape
+
+    def numParameters(self):
+        return self.U1.size + self.U2.size + self.U3.size + self.G.size
+
+    def toTensor(self):
+        return np.einsum('abc,ia,jb,zc->ijz', self.G, self.U1, self.U2, self.U3, optimize=True)
+
+    def K_u(self, u):
+        G_u = self.G @ (self.U3.T @ np.ravel(self.psi(u)))
+        return self.U1 @ G_u @ self.U2.T
+
+    def predict(self, Phi_X, U):
+        '''
+        K_u phi(x) for every column of the [k, b] matrix Phi_X and its action in U.
+        '''
+        Z = self.U2.T @ Phi_X
+        W = self.U3.T @ liftActions(self.psi, U)
+        return self.U1 @ np.einsum('abc,bn,cn->an', self.G, Z, W, optimize=True)
@@ -7,6 +7,8 @@ import matplotlib.pyplot as plt
 from sklearn.kernel_approximation import RBFSampler
 import scipy as sp
 import auxiliaryFns
+from multi_model import MultiKoopmanModel
+from rollout import rollout, horizonErrors
 
 
 def l2_norm(true_state, predicted_state):
@@ -72,7 +74,7 @@ gamma = np.quantile(pairwise_distances, 0.9)
 rbf_feature = RBFSampler(gamma=gamma, random_state=1)
 X_features = rbf_feature.fit_transform(X)
 def psi(x):
-    return X_features.T @ x.reshape((state_dim,1))
+    return X_features.T @ x.reshape((state_dim,-1))
 # X_0_features = rbf_feature.fit_transform(X_0)
 # X_1_features = rbf_feature.fit_transform(X_1)
 # k_0 = X_0_features.shape[1]
@@ -103,81 +105,86 @@ def psi(x):
 # Psi_X_1 = getPsiMatrix(psi, X_1_train).T
 # Psi_Y_1 = getPsiMatrix(psi, Y_1_train).T
 
-#%% Koopman
-# || Y         - X B           ||
-# || Y.T       - B.T X.T       ||
-# || Psi_Y_0   - K Psi_X_0     ||
-# || Psi_Y_0.T - Psi_X_0.T K.T ||
-K_0 = estimate_L.rrr(Psi_X_0.T, Psi_Y_0.T).T
-K_1 = estimate_L.rrr(Psi_X_1.T, Psi_Y_1.T).T
-eigenvalues_0, eigenvectors_0 = np.linalg.eig(K_0)
-eigenvalues_1, eigenvectors_1 = np.linalg.eig(K_1)
-eigenfunction_0 = list(map(lambda psi_x: np.dot(psi_x,eigenvectors_0[:,0]), Psi_X_0.T))
-eigenfunction_1 = list(map(lambda psi_x: np.dot(psi_x,eigenvectors_1[:,0]), Psi_X_1.T))
-
-
-plt.plot(eigenvectors_0[:,:3])
-plt.plot(eigenvectors_1[:,:3])
-plt.title("Eigenvectors of Koopman operator for action 0 and 1")
-plt.ylabel('Eigenvector Output')
-plt.xlabel('State Snapshots')
-plt.show()
-
-plt.plot(eigenfunction_0)
-plt.title("Eigenfunction 0 of Koopman operator for action 0")
-plt.ylabel('Eigenfunction Output')
-plt.xlabel('State Snapshots')
-plt.show()
-
-plt.plot(eigenfunction_1)
-plt.title("Eigenfunction 0 of Koopman operator for action 1")
-plt.ylabel('Eigenfunction Output')
-plt.xlabel('State Snapshots')
-B = estimate_L.rrr(Psi_X.T, X_train.T, state_dim) # SINDy taking too long
-
-#%% Prediction compounding error
-title = "Prediction compounding error:"
-print(title)
-
-env = gym.make('CartPole-v0')
-horizon = 1000
-num_trials = 1#000
-norms = []
-vector_field_arrays = []
-for i in range(num_trials):
-    action_path = [np.random.choice([0,1]) for i in range(horizon)]
-    trial_norms = []
-    true_state = env.reset()
-    predicted_state = true_state.copy()
-    vector_field_array = [true_state]
-    for h in range(horizon):
-        action = action_path[h]
-        psi_x = psi(predicted_state)
-        predicted_state = B.T @ K_0 @ psi_x if action == 0 else B.T @ K_1 @ psi_x
-        true_state, ___, __, _ = env.step(action)
-        vector_field_array.append(predicted_state.reshape(state_dim))
-        norm = l2_norm(true_state.reshape(-1,1), predicted_state)/l2_norm(true_state.reshape(-1,1), 0)
-        trial_norms.append(norm)
-    vector_field_arrays.append(vector_field_array)
-    norms.append(trial_norms)
-    # Test: try to populate a list with (3,) arrays and then check [:,:,1:]
-
-vector_field_arrays = np.array(vector_field_arrays)
-X_plot = vector_field_arrays[:,:,0].reshape((horizon * num_trials)+1) # cart pos
-Y_plot = vector_field_arrays[:,:,2].reshape((horizon * num_trials)+1) # pole angle
-U_plot = vector_field_arrays[:,:,1].reshape((horizon * num_trials)+1) # cart velocity
-V_plot = vector_field_arrays[:,:,3].reshape((horizon * num_trials)+1) # pole angular velocity
-
-plt.figure()
-plt.title("Vector Field of Koopman Predicted State Evolution")
-Q_plot = plt.quiver(X_plot, Y_plot, U_plot, V_plot)
-plt.show()
-
-plt.plot(np.mean(norms, axis=0))
-plt.title(title)
-plt.ylabel('L2 Norm')
-plt.xlabel('Timestep')
-plt.show()
+# the operators are fit in worker processes, which re-import this script
+if __name__ == '__main__':
+    #%% Koopman
+    # || Y         - X B           ||
+    # || Y.T       - B.T X.T       ||
+    # || Psi_Y_0   - K Psi_X_0     ||
+    # || Psi_Y_0.T - Psi_X_0.T K.T ||
+    # true next states of each action, labelled with the action they were taken with
+    X_fit = np.append(X_0_train, X_1_train, axis=1)
+    Y_fit = np.append(Y_0_train, Y_1_train, axis=1)
+    U_fit = np.append(np.zeros(X_0_train.shape[1], dtype=int), np.ones(X_1_train.shape[1], dtype=int))
+    model = MultiKoopmanModel(psi, num_actions=2, max_workers=2).fit(X_fit, Y_fit, U_fit)
+    K_0, K_1 = model.K
+    Psi_X = psi(X_train)
+    Psi_X_0 = psi(X_0_train)
+    Psi_X_1 = psi(X_1_train)
+    eigenvalues_0, eigenvectors_0 = np.linalg.eig(K_0)
+    eigenvalues_1, eigenvectors_1 = np.linalg.eig(K_1)
+    eigenfunction_0 = list(map(lambda psi_x: np.dot(psi_x,eigenvectors_0[:,0]), Psi_X_0.T))
+    eigenfunction_1 = list(map(lambda psi_x: np.dot(psi_x,eigenvectors_1[:,0]), Psi_X_1.T))
+
+
+    plt.plot(eigenvectors_0[:,:3])
+    plt.plot(eigenvectors_1[:,:3])
+    plt.title("Eigenvectors of Koopman operator for action 0 and 1")
+    plt.ylabel('Eigenvector Output')
+    plt.xlabel('State Snapshots')
+    plt.show()
+
+    plt.plot(eigenfunction_0)
+    plt.title("Eigenfunction 0 of Koopman operator for action 0")
+    plt.ylabel('Eigenfunction Output')
+    plt.xlabel('State Snapshots')
+    plt.show()
+
+    plt.plot(eigenfunction_1)
+    plt.title("Eigenfunction 0 of Koopman operator for action 1")
+    plt.ylabel('Eigenfunction Output')
+    plt.xlabel('State Snapshots')
+    B = estimate_L.rrr(Psi_X.T, X_train.T, state_dim) # SINDy taking too long
+
+    #%% Prediction compounding error
+    title = "Prediction compounding error:"
+    print(title)
+
+    env = gym.make('CartPole-v0')
+    horizon = 1000
+    num_trials = 1#000
+    action_paths = np.random.choice([0,1], size=(num_trials, horizon))
+    initial_states = np.empty((state_dim, num_trials))
+    true_trajectories = np.empty((horizon, state_dim, num_trials))
+    for i in range(num_trials):
+        initial_states[:,i] = env.reset()
+        for h in range(horizon):
+            true_trajectories[h,:,i] = env.step(action_paths[i,h])[0]
+
+    # all trials advance together, predicted states are lifted again after every step
+    predicted_trajectories = rollout(
+        model.predict, psi(initial_states), action_paths, output=B.T, reproject=psi
+    )
+    norms, stats = horizonErrors(true_trajectories, predicted_trajectories[1:])
+    norms = norms.T
+
+    # [num_trials, horizon+1, state_dim]
+    vector_field_arrays = predicted_trajectories.transpose(2, 0, 1)
+    X_plot = vector_field_arrays[:,:,0].reshape((horizon * num_trials)+1) # cart pos
+    Y_plot = vector_field_arrays[:,:,2].reshape((horizon * num_trials)+1) # pole angle
+    U_plot = vector_field_arrays[:,:,1].reshape((horizon * num_trials)+1) # cart velocity
+    V_plot = vector_field_arrays[:,:,3].reshape((horizon * num_trials)+1) # pole angular velocity
+
+    plt.figure()
+    plt.title("Vector Field of Koopman Predicted State Evolution")
+    Q_plot = plt.quiver(X_plot, Y_plot, U_plot, V_plot)
+    plt.show()
+
+    plt.plot(np.mean(norms, axis=0))
+    plt.title(title)
+    plt.ylabel('L2 Norm')
+    plt.xlabel('Timestep')
+    plt.show()
 
 
 """
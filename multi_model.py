@@ -0,0 +1,89 @@
+#%%
+import numpy as np
+import estimate_L
+from concurrent.futures import ProcessPoolExecutor
+
+def partition_by_action(U, num_actions):
+    """
+    Split snapshot indices by discrete action in a single pass
+
+        Parameters:
+            U: Action data as integers in [0, num_actions)
+            num_actions: Number of discrete actions
+
+        Returns:
+            partitions: List of index arrays, one per action
+    """
+    actions = np.asarray(U).reshape(-1).astype(int)
+    order = np.argsort(actions, kind='stable')
+    counts = np.bincount(actions, minlength=num_actions)
+    return np.split(order, np.cumsum(counts)[:-1])
+
+def _fit_operator(args):
+    # Module level so that it can be pickled into the worker processes
+    Psi_X_u, Psi_Y_u, rank = args
+    if Psi_X_u.shape[1] == 0:
+        return np.zeros((Psi_Y_u.shape[0], Psi_X_u.shape[0]))
+    # || Psi_Y_u.T - Psi_X_u.T K.T ||
+    return estimate_L.rrr(Psi_X_u.T, Psi_Y_u.T, rank).T
+
+class MultiKoopmanModel:
+    def __init__(self, psi, num_actions, rank=8, max_workers=1):
+        """
+        Create instance of model with one Koopman operator per discrete action
+
+            Parameters:
+                psi: Dictionary function that lifts a [d, m] matrix of states
+                num_actions: Number of discrete actions
+                rank: Rank used by the reduced rank regression
+                max_workers: Number of processes used to fit the operators (1 fits serially, None uses
+                    one per CPU and needs an `if __name__ == '__main__'` guard in scripts)
+        """
+        self.psi = psi
+        self.num_actions = num_actions
+        self.rank = rank
+        self.max_workers = max_workers
+        self.K = None
+
+    def fit(self, X, Y, U):
+        """
+        Fits K[u] for every action u from snapshot pairs
+
+            Parameters:
+                X: State data
+                Y: Next state data
+                U: Action data
+        """
+        # Lift once, then slice the lifted data per action
+        Psi_X = self.psi(X)
+        Psi_Y = self.psi(Y)
+        partitions = partition_by_action(U, self.num_actions)
+        jobs = [(Psi_X[:, inds], Psi_Y[:, inds], self.rank) for inds in partitions]
+
+        if self.max_workers == 1:
+            operators = list(map(_fit_operator, jobs))
+        else:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+                operators = list(pool.map(_fit_operator, jobs))
+
+        # Stacked as [num_actions, k, k] so K[u] picks the operator for action u
+        self.K = np.stack(operators)
+        return self
+
+    def predict(self, Psi_X, U):
+        """
+        One-step prediction in the lifted space
+
+            Parameters:
+                Psi_X: Lifted states as a [k, m] matrix
+                U: Actions as m integers
+
+            Returns:
+                Psi_Y: Predicted lifted next states as a [k, m] matrix
+        """
+        # Group the columns by action so each K[u] is applied with one product
+        Psi_Y = np.empty((self.K.shape[1], Psi_X.shape[1]), dtype=np.result_type(self.K, Psi_X))
+        for u, inds in enumerate(partition_by_action(U, self.num_actions)):
+            if inds.shape[0] > 0:
+                Psi_Y[:, inds] = self.K[u] @ Psi_X[:, inds]
+        return Psi_Y
@@ -5,6 +5,7 @@ codebase at https://github.com/sklus/d3s
 
 import math
 import numpy as np
+from scipy import sparse
 from scipy.spatial import distance
 
 
@@ -140,12 +141,8 @@ class indicators(object):
         [d, m] = x.shape # d = dimension of state space, m = number of test points
         n = self.Omega.numBoxes()
         y = np.zeros([n, m])
-        for i in range(m):
-            ind = self.Omega.index(x[:, i])
-            pass
-            if ind == -1:
-                continue
-            y[ind, i] = 1
+        ind, valid = self.Omega.index(x)
+        y[ind[valid], np.flatnonzero(valid)] = 1
         return y
 
     def __repr__(self):
@@ -208,6 +205,58 @@ class gaussians(object):
         return 'Gaussian functions for box discretization with bandwidth %f.' % self.sigma
 
 
+class onehots(object):
+    '''
+    One-hot indicators of the states of a finite grid, e.g. the (row, col, passenger,
+    destination) tuples of Taxi.
+
+    radices: number of values of each state component. States are numbered in mixed
+    radix with the last component varying fastest, which is the layout of Taxi's
+    env.encode and of nested loops over the components.
+    '''
+    def __init__(self, radices):
+        self.radices = tuple(int(r) for r in radices)
+
+    def numStates(self):
+        return int(np.prod(self.radices))
+
+    def encode(self, x):
+        '''
+        Index of every column of x.
+        '''
+        return np.ravel_multi_index(tuple(np.asarray(x, dtype=int)), self.radices)
+
+    def decode(self, ind):
+        '''
+        [d, m] states for m indices.
+        '''
+        return np.array(np.unravel_index(np.asarray(ind).reshape(-1), self.radices))
+
+    def decodeArgmax(self, y):
+        '''
+        States whose indicator is largest in every column of y, e.g. of predicted lifts.
+        '''
+        return self.decode(np.argmax(y, axis=0))
+
+    def sparse(self, x):
+        '''
+        One-hot columns of x as a sparse [n, m] matrix.
+        '''
+        m = x.shape[1]
+        return sparse.csc_matrix(
+            (np.ones(m), self.encode(x), np.arange(m+1)), shape=(self.numStates(), m)
+        )
+
+    def __call__(self, x):
+        m = x.shape[1]
+        y = np.zeros([self.numStates(), m])
+        y[self.encode(x), np.arange(m)] = 1
+        return y
+
+    def __repr__(self):
+        return 'One-hot indicators for %s states.' % 'x'.join('%d' % r for r in self.radices)
+
+
 # auxiliary functions
 def nchoosek(n, k):
     '''
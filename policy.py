@@ -0,0 +1,284 @@
+#%%
+import numpy as np
+from scipy import integrate
+from scipy.special import logsumexp
+
+def gaussLegendre(low, high, n_nodes):
+    '''
+    Gauss-Legendre nodes and weights mapped onto the action interval [low, high].
+    '''
+    nodes, weights = np.polynomial.legendre.leggauss(n_nodes)
+    half_width = 0.5 * (high - low)
+    return half_width * nodes + 0.5 * (high + low), half_width * weights
+
+def logGibbs(Q, lamb, weights=None):
+    '''
+    Normalised log Gibbs policy log pi = Q / lamb - log Z over the last axis of Q.
+    weights are quadrature weights for a continuous action interval (None for a finite
+    action set). Returns log_pi and log_Z.
+    '''
+    inner = Q / lamb
+    log_Z = logsumexp(inner, axis=-1, b=weights, keepdims=True)
+    return inner - log_Z, log_Z[..., 0]
+
+def softValue(Q, lamb, weights=None):
+    '''
+    Soft value E_pi[Q - lamb * log pi] = lamb * log Z over the last axis of Q.
+    '''
+    return lamb * logsumexp(Q / lamb, axis=-1, b=weights)
+
+def _columns(X):
+    X = np.asarray(X, dtype=float)
+    if X.ndim == 1: return X.reshape(-1,1)
+    return X
+
+class GibbsPolicy(object):
+    '''
+    Gibbs policy pi(u|x) = exp(score(x, u) / lamb) / Z(x) on the interval action_bounds.
+
+    score(X, U) takes a [d, b] matrix of states and b actions and returns the b values
+    of reward(x, u) + Lv(x, u). The log-partition function log Z(x) is computed once per
+    state on a Gauss-Legendre grid of n_nodes points (or with scipy's quad if n_nodes is
+    None) and cached, so the policy should be rebuilt whenever score changes.
+    '''
+
+    def __init__(self, score, action_bounds, lamb, n_nodes=16):
+        self.score = score
+        self.low, self.high = action_bounds
+        self.lamb = lamb
+        self.n_nodes = n_nodes
+        if n_nodes is not None:
+            self.nodes, self.weights = gaussLegendre(self.low, self.high, n_nodes)
+        self._log_Z = {}
+
+    def __call__(self, u, x):
+        '''
+        Density pi(u|x), kept compatible with the pi_hat_star(u, x) closures.
+        '''
+        density = np.exp(self.log_pi(u, x))
+        if np.isscalar(u) and np.ndim(x) == 1: return density[0]
+        return density
+
+    def _inner(self, X, U):
+        return np.asarray(self.score(X, U)).reshape(-1) / self.lamb
+
+    def cache(self, X, log_Z):
+        '''
+        Stores already computed log-partition values for the columns of X.
+        '''
+        X = np.ascontiguousarray(_columns(X).T)
+        for x, value in zip(X, np.asarray(log_Z).reshape(-1)):
+            self._log_Z[x.tobytes()] = value
+
+    def log_partition(self, X):
+        '''
+        log Z(x) for every column of X, integrating only over states not seen before.
+        '''
+        X = _columns(X)
+        rows = np.ascontiguousarray(X.T)
+        keys = [x.tobytes() for x in rows]
+        missing = {}
+        for i, key in enumerate(keys):
+            if key not in self._log_Z and key not in missing: missing[key] = i
+
+        if missing:
+            inds = np.fromiter(missing.values(), dtype=int)
+            X_missing = X[:, inds]
+            if self.n_nodes is None:
+                log_Z = np.array([self._adaptive_log_partition(x) for x in X_missing.T])
+            else:
+                n = self.n_nodes
+                inner = self._inner(
+                    np.repeat(X_missing, n, axis=1), np.tile(self.nodes, inds.shape[0])
+                ).reshape(inds.shape[0], n)
+                log_Z = logsumexp(inner, axis=1, b=self.weights)
+            for key, value in zip(missing, log_Z):
+                self._log_Z[key] = value
+
+        return np.array([self._log_Z[key] for key in keys])
+
+    def _adaptive_log_partition(self, x):
+        # shift by the largest exponent on a coarse grid so the integrand stays in range
+        x = x.reshape(-1,1)
+        coarse = np.linspace(self.low, self.high, 9)
+        shift = np.max(self._inner(np.repeat(x, coarse.shape[0], axis=1), coarse))
+        integral = integrate.quad(
+            lambda u: np.exp(self._inner(x, np.array([u]))[0] - shift), self.low, self.high
+        )[0]
+        return shift + np.log(integral)
+
+    def log_pi(self, U, X):
+        '''
+        log pi(u|x) for a batch of actions U and states X (a single state is broadcast).
+        '''
+        U = np.asarray(U, dtype=float).reshape(-1)
+        X = _columns(X)
+        if X.shape[1] == 1 and U.shape[0] > 1:
+            X = np.repeat(X, U.shape[0], axis=1)
+        return self._inner(X, U) - self.log_partition(X)
+
+class TabulatedPolicy(object):
+    '''
+    Gibbs policy compiled into a table of reward + Lv on a uniform action grid.
+
+    The table for the training states X is regressed onto the state dictionary phi, which
+    is exact when reward + Lv is linear in phi(x) for every fixed action (e.g. monomials).
+    New states cost one lift and one matmul, actions in between grid points are linearly
+    interpolated in log pi. log Z is taken on the Gauss-Legendre nodes of the source policy.
+    The table is built chunk_size states at a time and fitted through the normal equations,
+    so memory does not grow with the number of training states times the grid size.
+
+    error_bound is a heuristic estimate of |log pi_tabulated - log pi|, not a bound: twice
+    the regression residual over lamb plus the interpolation term max|Delta^2 log pi|/8,
+    both measured on the training states only. The quadrature error of log Z on the Gauss
+    nodes is not included.
+    '''
+
+    def __init__(self, policy, X, phi, n_actions=65, n_nodes=None, chunk_size=1024):
+        self.low, self.high = policy.low, policy.high
+        self.lamb = policy.lamb
+        self.phi = phi
+        self.actions = np.linspace(self.low, self.high, n_actions)
+        self.h = self.actions[1] - self.actions[0]
+        if n_nodes is None: n_nodes = getattr(policy, 'n_nodes', None) or 16
+        self.nodes, self.weights = gaussLegendre(self.low, self.high, n_nodes)
+
+        m = X.shape[1]
+        grid = np.append(self.actions, self.nodes)
+        chunks = [slice(start, min(start + chunk_size, m)) for start in range(0, m, chunk_size)]
+        # Phi_X Phi_X^T and Phi_X Q accumulated over the chunks, only Q [m, grid] is kept
+        Q = np.empty((m, grid.shape[0]))
+        gram, moments = 0, 0
+        for chunk in chunks:
+            X_chunk = X[:, chunk]
+            b = X_chunk.shape[1]
+            Q[chunk] = np.asarray(policy.score(
+                np.repeat(X_chunk, grid.shape[0], axis=1), np.tile(grid, b)
+            )).reshape(b, grid.shape[0])
+            Phi_chunk = phi(X_chunk)
+            gram = gram + Phi_chunk @ Phi_chunk.T
+            moments = moments + Phi_chunk @ Q[chunk]
+        self.W = np.linalg.lstsq(gram, moments, rcond=None)[0]
+
+        residual, curvature = 0, 0
+        for chunk in chunks:
+            Phi_chunk = phi(X[:, chunk])
+            residual = max(residual, np.max(np.abs(Phi_chunk.T @ self.W - Q[chunk])))
+            if n_actions > 2:
+                log_pi = self._log_pi_table(Phi_chunk)
+                curvature = max(curvature, np.max(np.abs(np.diff(log_pi, 2, axis=1))))
+        self.error_bound = 2 * residual / self.lamb + curvature / 8
+
+    @classmethod
+    def fromArrays(cls, W, actions, nodes, weights, lamb, phi, error_bound=np.nan):
+        '''
+        Rebuilds a tabulated policy from stored arrays (see GeneratorModel.load).
+        '''
+        policy = cls.__new__(cls)
+        policy.low, policy.high = actions[0], actions[-1]
+        policy.lamb = lamb
+        policy.phi = phi
+        policy.actions = actions
+        policy.h = actions[1] - actions[0]
+        policy.nodes, policy.weights = nodes, weights
+        policy.W = W
+        policy.error_bound = error_bound
+        return policy
+
+    def __call__(self, u, x):
+        density = np.exp(self.log_pi(u, x))
+        if np.isscalar(u) and np.ndim(x) == 1: return density[0]
+        return density
+
+    def log_pi_table(self, X):
+        '''
+        [b, n_actions] table of log pi on the action grid for the columns of X.
+        '''
+        return self._log_pi_table(self.phi(_columns(X)))
+
+    def _log_pi_table(self, Phi_X):
+        n = self.actions.shape[0]
+        Q = Phi_X.T @ self.W
+        log_Z = logsumexp(Q[:, n:] / self.lamb, axis=1, b=self.weights, keepdims=True)
+        return Q[:, :n] / self.lamb - log_Z
+
+    def log_pi(self, U, X):
+        '''
+        log pi(u|x) for a batch of actions U and states X (a single state is broadcast).
+        '''
+        U = np.asarray(U, dtype=float).reshape(-1)
+        table = self.log_pi_table(X)
+        rows = np.zeros(U.shape[0], dtype=int) if table.shape[0] == 1 else np.arange(U.shape[0])
+        position = (np.clip(U, self.low, self.high) - self.low) / self.h
+        j = np.minimum(position.astype(int), self.actions.shape[0] - 2)
+        t = position - j
+        return (1 - t) * table[rows, j] + t * table[rows, j+1]
+
+def costTable(cost, X, actions, vectorized_cost=False):
+    '''
+    [m, A] matrix of cost(x, u) for every column of X and every action.
+    '''
+    m, A = X.shape[1], len(actions)
+    if vectorized_cost:
+        U = np.tile(np.asarray(actions), m)
+        return np.asarray(cost(np.repeat(X, A, axis=1), U), dtype=float).reshape(m, A)
+    return np.array([[cost(x, u) for u in actions] for x in X.T], dtype=float)
+
+class DiscreteGibbsPolicy(object):
+    '''
+    Gibbs policy pi(u|x) proportional to exp(-(cost(x, u) + w K_u phi(x)) / lamb) over a
+    finite action set, evaluated for whole batches of states as [m, A] arrays.
+
+    tensor is a KoopmanTensor with K_u cached for the actions. Methods take the lifted
+    states Phi_X and the [m, A] cost table C (see costTable) so they can be reused.
+    '''
+
+    def __init__(self, tensor, w, lamb=1):
+        self.tensor = tensor
+        self.w = w
+        self.lamb = lamb
+
+    @property
+    def actions(self):
+        return self.tensor.actions
+
+    def next_values(self, Phi_X):
+        '''
+        [m, A] matrix of w K_u phi(x).
+        '''
+        return ((self.w @ self.tensor.K_U) @ Phi_X).T
+
+    def Q(self, Phi_X, C):
+        return -(C + self.next_values(Phi_X))
+
+    def log_pi_table(self, Phi_X, C):
+        '''
+        [m, A] normalised log-probabilities.
+        '''
+        return logGibbs(self.Q(Phi_X, C), self.lamb)[0]
+
+    def expectation(self, F, Phi_X, C):
+        '''
+        E_pi[F] for an [m, A] table F, one value per state.
+        '''
+        return np.sum(np.exp(self.log_pi_table(Phi_X, C)) * F, axis=1)
+
+    def value(self, Phi_X, C):
+        '''
+        Soft value E_pi[Q - lamb * log pi] = lamb * log Z for every state.
+        '''
+        return softValue(self.Q(Phi_X, C), self.lamb)
+
+    def sample(self, Phi_X, C, rng=None):
+        '''
+        One action per state by the Gumbel-max trick.
+        '''
+        if rng is None: rng = np.random.default_rng()
+        Q = self.Q(Phi_X, C) / self.lamb
+        return self.actions[np.argmax(Q + rng.gumbel(size=Q.shape), axis=1)]
+
+def stateFeatures(psi):
+    '''
+    State dictionary phi(x) = psi([x; 0]) for a dictionary psi on extended states [x; u].
+    '''
+    return lambda X: psi(np.append(X, np.zeros((1, X.shape[1])), axis=0))
@@ -0,0 +1,54 @@
+#%%
+import numpy as np
+
+def rollout(step, Z0, U, output=None, reproject=None):
+    '''
+    Advances n trajectories together for H steps, one batched step per horizon.
+
+        Parameters:
+            step: step(Z, u) -> next Z for a [k, n] batch and n actions, e.g. the predict
+                of MultiKoopmanModel or KoopmanTensor
+            Z0: [k, n] initial (lifted) states
+            U: [n, H] action sequences
+            output: Optional [d, k] matrix mapping lifted states to states (e.g. B.T)
+            reproject: Optional function that lifts the [d, n] predicted states again
+                after every step (e.g. psi)
+
+        Returns:
+            trajectory: [H+1, d, n] predicted states (lifted states if output is None),
+                trajectory[0] holds the initial states (mapped through output)
+    '''
+    U = np.asarray(U).reshape(Z0.shape[1], -1)
+    H = U.shape[1]
+    Z = Z0
+    first = Z if output is None else output @ Z
+    trajectory = np.empty((H+1,) + first.shape, dtype=np.result_type(first, float))
+    trajectory[0] = first
+    for h in range(H):
+        Z = step(Z, U[:, h])
+        trajectory[h+1] = Z if output is None else output @ Z
+        if reproject is not None: Z = reproject(trajectory[h+1])
+    return trajectory
+
+def horizonErrors(true_trajectory, predicted_trajectory, relative=True):
+    '''
+    Squared prediction errors per horizon and trajectory, with statistics over trajectories.
+
+        Parameters:
+            true_trajectory: [H, d, n] true states
+            predicted_trajectory: [H, d, n] predicted states
+            relative: Divide by the squared norm of the true state
+
+        Returns:
+            norms: [H, n] errors
+            stats: Dictionary of mean, median, std and max over trajectories, each [H]
+    '''
+    norms = np.sum(np.power(true_trajectory - predicted_trajectory, 2), axis=1)
+    if relative: norms = norms / np.sum(np.power(true_trajectory, 2), axis=1)
+    stats = {
+        'mean': np.mean(norms, axis=1),
+        'median': np.median(norms, axis=1),
+        'std': np.std(norms, axis=1),
+        'max': np.max(norms, axis=1)
+    }
+    return norms, stats
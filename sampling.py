@@ -0,0 +1,74 @@
+#%%
+import numpy as np
+
+def piecewiseLinearCDF(actions, log_density):
+    '''
+    CDFs of the piecewise linear densities through exp(log_density) on a uniform action grid.
+
+        Parameters:
+            actions: Uniform grid of n actions
+            log_density: [b, n] unnormalised log densities, one row per state
+
+        Returns:
+            density: [b, n] densities normalised to integrate to one
+            cdf: [b, n] CDF at the grid points (first column 0, last column 1)
+    '''
+    h = actions[1] - actions[0]
+    density = np.exp(log_density - np.max(log_density, axis=1, keepdims=True))
+    masses = 0.5 * h * (density[:, :-1] + density[:, 1:])
+    cdf = np.zeros_like(density)
+    np.cumsum(masses, axis=1, out=cdf[:, 1:])
+    total = cdf[:, -1:].copy()
+    return density / total, cdf / total
+
+def inverseCDF(actions, density, cdf, Y):
+    '''
+    Exact inverse of the piecewise linear CDFs for [b, s] uniform draws Y, all rows at once.
+    '''
+    b, n = cdf.shape
+    h = actions[1] - actions[0]
+
+    # offset row i into [i, i+1] so one searchsorted covers every state
+    offsets = np.arange(b).reshape(-1,1)
+    cells = np.searchsorted((cdf + offsets).ravel(), (Y + offsets).ravel(), side='right')
+    cells = cells.reshape(Y.shape) - offsets * n - 1
+    j = np.clip(cells, 0, n - 2)
+
+    rows = np.broadcast_to(offsets, Y.shape)
+    p = density[rows, j]
+    slope = (density[rows, j+1] - p) / h
+    r = np.maximum(Y - cdf[rows, j], 0)
+
+    # solve p s + slope s^2 / 2 = r for the offset s into the cell
+    flat = np.abs(slope) * h < 1e-12 * np.maximum(p, 1e-300)
+    safe_slope = np.where(flat, 1, slope)
+    s = np.where(
+        flat,
+        r / np.maximum(p, 1e-300),
+        (np.sqrt(np.maximum(p**2 + 2 * safe_slope * r, 0)) - p) / safe_slope
+    )
+    return actions[j] + np.clip(s, 0, h)
+
+def sampleActions(actions, log_density, num_samples=1, rng=None):
+    '''
+    Draws num_samples actions for every state from tabulated log densities.
+
+        Parameters:
+            actions: Uniform grid of n actions
+            log_density: [b, n] log densities on the grid, one row per state
+            num_samples: Number of actions drawn per state
+            rng: numpy Generator (defaults to np.random.default_rng())
+
+        Returns:
+            U: [b, num_samples] sampled actions
+    '''
+    if rng is None: rng = np.random.default_rng()
+    density, cdf = piecewiseLinearCDF(actions, log_density)
+    Y = rng.random((cdf.shape[0], num_samples))
+    return inverseCDF(actions, density, cdf, Y)
+
+def samplePolicy(pi_table, X, num_samples=1, rng=None):
+    '''
+    Draws num_samples actions for every column of X from a TabulatedPolicy.
+    '''
+    return sampleActions(pi_table.actions, pi_table.log_pi_table(X), num_samples, rng)
@@ -0,0 +1,135 @@
+#%%
+import numpy as np
+
+class SnapshotBuffer(object):
+    '''
+    Preallocated column store for snapshot matrices such as X, X_tilde, Psi_X_tilde and
+    dPsi_X_tilde that grow by a few columns per step.
+
+    Without max_size the storage grows by amortised doubling. With max_size it is a
+    fixed-capacity sliding window that keeps the most recent max_size columns. The window
+    is stored twice side by side, so the current contents are always one contiguous slice
+    and view() never copies.
+    '''
+
+    def __init__(self, num_rows, capacity=64, max_size=None, dtype=float):
+        self.max_size = max_size
+        if max_size is not None: capacity = max_size
+        self._capacity = max(int(capacity), 1)
+        width = 2 * self._capacity if max_size is not None else self._capacity
+        self._data = np.empty((num_rows, width), dtype=dtype)
+        self._count = 0 # number of columns ever appended
+
+    @classmethod
+    def fromArray(cls, A, max_size=None, total=None):
+        '''
+        Buffer holding the columns of A. total is the number of columns ever appended
+        when A is the current window of a sliding buffer (defaults to the width of A).
+        '''
+        buffer = cls(A.shape[0], max(2 * A.shape[1], 64), max_size, A.dtype)
+        if total is not None: buffer._count = total - A.shape[1]
+        buffer.extend(A)
+        return buffer
+
+    @classmethod
+    def wrap(cls, A, max_size=None, total=None):
+        '''
+        Uses A (e.g. a read-only memory map) as the storage without copying. The first
+        append moves the data into a fresh, growable array.
+        '''
+        if max_size is not None: return cls.fromArray(A, max_size, total)
+        buffer = cls.__new__(cls)
+        buffer.max_size = None
+        buffer._capacity = A.shape[1]
+        buffer._data = A
+        buffer._count = A.shape[1]
+        return buffer
+
+    def __len__(self):
+        if self.max_size is None: return self._count
+        return min(self._count, self._capacity)
+
+    @property
+    def total(self):
+        '''
+        Number of columns ever appended, including those that left the window.
+        '''
+        return self._count
+
+    @property
+    def shape(self):
+        return (self._data.shape[0], len(self))
+
+    def _start(self):
+        if self.max_size is None: return 0
+        return (self._count - len(self)) % self._capacity
+
+    def view(self):
+        '''
+        Zero-copy [num_rows, n] view of the stored columns, oldest first.
+        '''
+        start = self._start()
+        return self._data[:, start:start+len(self)]
+
+    def __getitem__(self, key):
+        return self.view()[key]
+
+    def append(self, column):
+        self.extend(np.asarray(column).reshape(-1,1))
+
+    def extend(self, block):
+        '''
+        Appends the columns of a [num_rows, b] block.
+        '''
+        block = np.asarray(block).reshape(self._data.shape[0], -1)
+        b = block.shape[1]
+        if self.max_size is None:
+            if self._count + b > self._capacity:
+                self._grow(self._count + b)
+            self._data[:, self._count:self._count+b] = block
+            self._count += b
+            return
+
+        # only the last capacity columns can survive
+        if b > self._capacity:
+            self._count += b - self._capacity
+            block = block[:, -self._capacity:]
+            b = self._capacity
+        positions = (self._count + np.arange(b)) % self._capacity
+        self._data[:, positions] = block
+        self._data[:, positions + self._capacity] = block
+        self._count += b
+
+    def set_column(self, j, column):
+        '''
+        Overwrites column j of view(), keeping both copies of the window in sync.
+        '''
+        j = range(len(self))[j]
+        if self.max_size is None:
+            self._data[:, j] = column
+            return
+        position = (self._start() + j) % self._capacity
+        self._data[:, position] = column
+        self._data[:, position + self._capacity] = column
+
+    def set_columns(self, j, block):
+        '''
+        Overwrites the columns j, j+1, ... of view() with the columns of block.
+        '''
+        block = np.asarray(block).reshape(self._data.shape[0], -1)
+        j = range(len(self))[j]
+        if j + block.shape[1] > len(self): raise IndexError('block does not fit in the buffer')
+        if self.max_size is None:
+            self._data[:, j:j+block.shape[1]] = block
+            return
+        positions = (self._start() + j + np.arange(block.shape[1])) % self._capacity
+        self._data[:, positions] = block
+        self._data[:, positions + self._capacity] = block
+
+    def _grow(self, required):
+        capacity = max(self._capacity, 1)
+        while capacity < required: capacity *= 2
+        data = np.empty((self._data.shape[0], capacity), dtype=self._data.dtype)
+        data[:, :self._count] = self._data[:, :self._count]
+        self._data = data
+        self._capacity = capacity